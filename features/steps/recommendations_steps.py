@@ -28,21 +28,16 @@ from behave import given
 # HTTP Return Codes
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
-HTTP_204_NO_CONTENT = 204
 
 
 @given("the following recommendations")
 def step_impl(context):
     """Delete all Recommendations and load new ones"""
 
-    # List all of the Recommendations and delete them one by one
+    # Delete all of the Recommendations with a single request
     rest_endpoint = f"{context.base_url}/recommendations"
-    context.resp = requests.get(rest_endpoint)
+    context.resp = requests.delete(rest_endpoint, params={"all": "true"})
     assert context.resp.status_code == HTTP_200_OK
-    for recommendation in context.resp.json():
-        recommendation_id = recommendation["id"]
-        context.resp = requests.delete(f"{rest_endpoint}/{recommendation_id}")
-        assert context.resp.status_code == HTTP_204_NO_CONTENT
 
     # load the database with new Recommendations
     for row in context.table:
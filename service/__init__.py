@@ -67,12 +67,15 @@ def create_app():
         # pylint: disable=cyclic-import
         from service import routes, models  # noqa: F401, E402
         from service.common import error_handlers
-        from service.models import db
+        from service.models import db, RecommendationTop
+        from service.cache import cache
 
         db.init_app(app)
+        cache.init_app(app)
 
         try:
             db.create_all()
+            RecommendationTop.init_app(app)
         except Exception as error:  # pylint: disable=broad-except
             app.logger.critical("%s: Cannot continue", error)
             # gunicorn requires exit code 4 to stop spawning workers when they die
@@ -0,0 +1,77 @@
+"""
+Package: cache
+
+Read-through cache for the Recommendation read paths
+
+The models fetch through the module level cache object, which is a no-op
+until init_app() enables a backend from the configuration. CACHE_BACKEND names
+one of the BACKENDS: a cache per process, per pod or shared by every replica.
+"""
+from service.cache.base import CacheBackend
+from service.cache.memory import MemoryCache
+from service.cache.redis import RedisCache
+from service.cache.shared import SharedMemoryCache
+
+BACKENDS = {backend.name: backend for backend in (MemoryCache, SharedMemoryCache, RedisCache)}
+
+
+class Cache:
+    """Read-through cache in front of the database"""
+
+    def __init__(self):
+        self.backend: CacheBackend = None
+
+    def init_app(self, app):
+        """Creates the backend selected by the app configuration"""
+        self.backend = None
+        if not app.config["CACHE_ENABLED"]:
+            return
+        name = app.config["CACHE_BACKEND"]
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown CACHE_BACKEND {name!r}, expected one of {sorted(BACKENDS)}")
+        self.backend = BACKENDS[name].from_config(app.config)
+        app.logger.info("Cache enabled: %s", self.backend.stats())
+
+    @property
+    def enabled(self) -> bool:
+        """True if lookups go through a backend"""
+        return self.backend is not None
+
+    def fetch(self, key: str, tags, loader):
+        """Returns the value cached under key, calling loader() to fill a miss
+
+        The value returned by loader() is cached even when it is None, so that
+        lookups of missing rows are answered from the cache too.
+
+        Args:
+            key (str): identifies the query and its arguments
+            tags (tuple): names used to invalidate the entry when data changes
+            loader (callable): reads the value from the database
+        """
+        if self.backend is None:
+            return loader()
+        found, value = self.backend.get(key)
+        if found:
+            return value
+        value = loader()
+        self.backend.set(key, value, tags)
+        return value
+
+    def invalidate(self, *tags):
+        """Drops every entry cached with any of the tags"""
+        if self.backend is not None:
+            self.backend.invalidate(*tags)
+
+    def clear(self):
+        """Drops every entry"""
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self) -> dict:
+        """Returns the counters of the backend"""
+        if self.backend is None:
+            return {"backend": None}
+        return self.backend.stats()
+
+
+cache = Cache()
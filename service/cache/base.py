@@ -0,0 +1,37 @@
+"""
+Cache backend interface
+
+Every backend caches JSON serializable values under string keys for a time to
+live, and tags each entry with names that a write uses to drop it again.
+"""
+
+
+class CacheBackend:
+    """Base class of the backends that the cache facade can be configured with"""
+
+    name = None  # the CACHE_BACKEND value that selects the backend
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the backend from the app configuration"""
+        raise NotImplementedError
+
+    def get(self, key: str) -> tuple:
+        """Returns (True, value) if key is cached and fresh, (False, None) otherwise"""
+        raise NotImplementedError
+
+    def set(self, key: str, value, tags=()):
+        """Caches value under key, tagged with tags"""
+        raise NotImplementedError
+
+    def invalidate(self, *tags):
+        """Drops every entry cached with any of the tags"""
+        raise NotImplementedError
+
+    def clear(self):
+        """Drops every entry"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Returns the counters of the backend, "backend" names it"""
+        raise NotImplementedError
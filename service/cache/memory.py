@@ -0,0 +1,87 @@
+"""
+In-process cache backend
+
+A bounded least recently used cache whose entries expire after a time to live.
+Entries are grouped by tags so that a write can drop every entry it affects.
+"""
+import threading
+import time
+from collections import Counter, OrderedDict
+from service.cache.base import CacheBackend
+
+
+class MemoryCache(CacheBackend):
+    """A thread safe LRU cache with a TTL, kept in the memory of one process"""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 5.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires, value, tags)
+        self._tags = {}  # tag -> set of keys
+        self._lock = threading.Lock()
+        self.counts = Counter()  # hits, misses and evictions
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config["CACHE_MAX_ENTRIES"], config["CACHE_TTL"])
+
+    def get(self, key: str) -> tuple:
+        """Returns (True, value) if key is cached and fresh, (False, None) otherwise"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.counts["misses"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.counts["hits"] += 1
+            return True, entry[1]
+
+    def set(self, key: str, value, tags=()):
+        """Caches value under key, evicting the least recently used entries if full"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.counts["evictions"] += 1
+
+    def invalidate(self, *tags):
+        """Drops every entry cached with any of the tags"""
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.get(tag, set()).copy():
+                    self._remove(key)
+
+    def clear(self):
+        """Drops every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self) -> dict:
+        """Returns the counters and size of the cache"""
+        with self._lock:
+            return {
+                "backend": "memory",
+                "hits": self.counts["hits"],
+                "misses": self.counts["misses"],
+                "evictions": self.counts["evictions"],
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+    def _remove(self, key: str):
+        """Removes an entry and its tags, the caller must hold the lock"""
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
@@ -0,0 +1,215 @@
+"""
+Redis cache backend
+
+A cache that every replica of the service shares, kept in a Redis server (or
+anything that speaks its protocol). A pod that starts cold reads the entries
+the other replicas already filled instead of sending every lookup to Postgres.
+
+Entries are plain string keys with a PX expiry. Each tag is a set of the keys
+tagged with it, so invalidating a tag deletes its members. The client speaks
+RESP over one socket per thread and pipelines the commands of each operation.
+
+The cache fails open: when Redis cannot be reached the lookups are counted as
+errors and answered by the database.
+"""
+import json
+import logging
+import socket
+import threading
+from collections import Counter
+from urllib.parse import unquote, urlsplit
+from service.cache.base import CacheBackend
+
+logger = logging.getLogger("flask.app")
+
+SCAN_COUNT = 1000
+
+
+class RedisError(Exception):
+    """Used for error replies of the server"""
+
+
+class RedisCache(CacheBackend):  # pylint: disable=too-many-instance-attributes
+    """A cache with a TTL that every replica connected to one Redis shares"""
+
+    name = "redis"
+
+    def __init__(
+        self,
+        url: str = "redis://localhost:6379/0",
+        ttl: float = 5.0,
+        prefix: str = "recommendation:",
+        timeout: float = 0.5,
+    ):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.db = int(parts.path.strip("/") or 0)
+        self.password = unquote(parts.password) if parts.password else None
+        self.ttl = ttl
+        self.prefix = prefix
+        self.timeout = timeout
+        self._local = threading.local()
+        self.counts = Counter()  # hits, misses and errors of this process
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config["CACHE_REDIS_URL"],
+            config["CACHE_TTL"],
+            config["CACHE_REDIS_PREFIX"],
+            config["CACHE_REDIS_TIMEOUT"],
+        )
+
+    ##################################################
+    # Cache interface
+    ##################################################
+
+    def get(self, key: str) -> tuple:
+        try:
+            (data,) = self._execute(("GET", self._key(key)))
+        except (OSError, RedisError) as error:
+            self._failed("get", error)
+            return False, None
+        if data is None:
+            self.counts["misses"] += 1
+            return False, None
+        self.counts["hits"] += 1
+        return True, json.loads(data)
+
+    def set(self, key: str, value, tags=()):
+        entry = self._key(key)
+        milliseconds = max(int(self.ttl * 1000), 1)
+        commands = [("SET", entry, json.dumps(value), "PX", milliseconds)]
+        for tag in tags:
+            # a tag outlives every entry it was added to
+            commands.append(("SADD", self._tag(tag), entry))
+            commands.append(("PEXPIRE", self._tag(tag), milliseconds))
+        try:
+            self._execute(*commands)
+        except (OSError, RedisError) as error:
+            self._failed("set", error)
+
+    def invalidate(self, *tags):
+        if not tags:
+            return
+        try:
+            members = self._execute(*(("SMEMBERS", self._tag(tag)) for tag in tags))
+            commands = []
+            for tag, keys in zip(tags, members):
+                if keys:
+                    # SREM rather than DEL keeps keys tagged since SMEMBERS
+                    commands.append(("DEL", *keys))
+                    commands.append(("SREM", self._tag(tag), *keys))
+            if commands:
+                self._execute(*commands)
+        except (OSError, RedisError) as error:
+            self._failed("invalidate", error)
+
+    def clear(self):
+        try:
+            cursor = "0"
+            while True:
+                ((cursor, keys),) = self._execute(
+                    ("SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", SCAN_COUNT)
+                )
+                if keys:
+                    self._execute(("DEL", *keys))
+                if cursor in ("0", b"0"):
+                    break
+        except (OSError, RedisError) as error:
+            self._failed("clear", error)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis",
+            "hits": self.counts["hits"],
+            "misses": self.counts["misses"],
+            "errors": self.counts["errors"],
+            "server": f"{self.host}:{self.port}/{self.db}",
+        }
+
+    ##################################################
+    # Protocol
+    ##################################################
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}key:{key}"
+
+    def _tag(self, tag: str) -> str:
+        return f"{self.prefix}tag:{tag}"
+
+    def _failed(self, operation: str, error: Exception):
+        """Counts an error and drops the connection so the next call reconnects"""
+        self.counts["errors"] += 1
+        logger.warning("Redis cache %s failed: %s", operation, error)
+        self.close()
+
+    def close(self):
+        """Closes the connection of the calling thread"""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            self._local.connection = None
+            connection[1].close()
+            connection[0].close()
+
+    def _connection(self):
+        """Returns the (socket, reader) of the calling thread, connecting if needed"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            connection = (sock, sock.makefile("rb"))
+            self._local.connection = connection
+            setup = []
+            if self.password:
+                setup.append(("AUTH", self.password))
+            if self.db:
+                setup.append(("SELECT", self.db))
+            if setup:
+                self._execute(*setup)
+        return connection
+
+    def _execute(self, *commands) -> list:
+        """Sends the commands in one pipeline and returns their replies"""
+        sock, reader = self._connection()
+        sock.sendall(b"".join(_encode(command) for command in commands))
+        replies = [_read_reply(reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+
+def _encode(command) -> bytes:
+    """Encodes a command as a RESP array of bulk strings"""
+    parts = [f"*{len(command)}\r\n".encode()]
+    for argument in command:
+        data = argument if isinstance(argument, bytes) else str(argument).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+def _read_reply(reader):  # pylint: disable=too-many-return-statements
+    """Reads one RESP reply, an error reply is returned as a RedisError"""
+    line = reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by the Redis server")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode("utf-8")
+    if kind == b"-":
+        return RedisError(payload.decode("utf-8"))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [_read_reply(reader) for _ in range(length)]
+    raise RedisError(f"Unknown reply type {kind!r}")
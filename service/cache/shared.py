@@ -0,0 +1,293 @@
+"""
+Shared memory cache backend
+
+A fixed size hash table in a memory mapped file, normally under /dev/shm, that
+every gunicorn worker of a pod maps. One worker fills an entry and all of them
+read it, and an invalidation made by any worker is seen by the others at once.
+
+Layout of the file:
+
+    header | tag generations | slots
+
+Keys hash to a set of WAYS neighbouring slots, and the least recently used slot
+of the set is evicted when it is full. Entries remember the generation of their
+tags when they were written; invalidating a tag bumps its generation, which
+makes every entry written before stale. clear() bumps a global generation.
+
+Writers hold an exclusive flock on the file. Readers take no lock: every slot
+starts with a sequence number that is odd while it is being written, and a read
+is retried when the number changed underneath it (a seqlock).
+"""
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import Counter
+from service.cache.base import CacheBackend
+
+MAGIC = b"RECCACH1"
+WAYS = 4
+MAX_TAGS = 4
+READ_RETRIES = 3
+
+# magic, slot size, slot count, tag count, global generation, evictions
+HEADER = struct.Struct("<8sIIIQQ")
+HEADER_SIZE = 64
+GENERATION = struct.Struct("<Q")
+SEQUENCE = struct.Struct("<I")
+# sequence, key hash, expires, last used, key length, value length,
+# global generation, number of tags
+SLOT = struct.Struct("<IQddHIQB")
+# tag index, tag generation
+SLOT_TAG = struct.Struct("<IQ")
+SLOT_DATA = SLOT.size + MAX_TAGS * SLOT_TAG.size
+
+
+def default_path() -> str:
+    """Returns the file used when no path is configured"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "recommendation-cache")
+
+
+def _hash(data: bytes) -> int:
+    """Returns a hash that is the same in every process, never 0"""
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little") or 1
+
+
+class SharedMemoryCache(CacheBackend):  # pylint: disable=too-many-instance-attributes
+    """A cache with a TTL that every process mapping the same file shares"""
+
+    name = "shared"
+
+    def __init__(
+        self,
+        path: str = None,
+        size: int = 16 * 1024 * 1024,
+        slot_size: int = 8192,
+        ttl: float = 5.0,
+        tag_count: int = 65536,
+    ):
+        self.path = path or default_path()
+        self.ttl = ttl
+        self.slot_size = slot_size
+        self.tag_count = tag_count
+        self.slot_count = (size - HEADER_SIZE - tag_count * GENERATION.size) // slot_size
+        self.slot_count -= self.slot_count % WAYS
+        if self.slot_count < WAYS or slot_size <= SLOT_DATA:
+            raise ValueError(f"Shared cache of {size} bytes is too small for {slot_size} byte slots")
+        self.size = HEADER_SIZE + tag_count * GENERATION.size + self.slot_count * slot_size
+        self._slots_offset = HEADER_SIZE + tag_count * GENERATION.size
+        self._lock = threading.Lock()
+        self.counts = Counter()  # hits, misses and oversize values of this process
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._write_lock():
+            if os.fstat(self._fd).st_size != self.size or os.pread(self._fd, len(MAGIC), 0) != MAGIC:
+                self._format()
+        self._map = mmap.mmap(self._fd, self.size)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config["CACHE_SHM_PATH"],
+            config["CACHE_SHM_SIZE"],
+            config["CACHE_SHM_SLOT_SIZE"],
+            config["CACHE_TTL"],
+        )
+
+    ##################################################
+    # Cache interface
+    ##################################################
+
+    def get(self, key: str) -> tuple:
+        """Returns (True, value) if key is cached and fresh, (False, None) otherwise"""
+        key_bytes = key.encode("utf-8")
+        key_hash = _hash(key_bytes)
+        for offset in self._set_offsets(key_hash):
+            entry = self._read_slot(offset)
+            if entry is None or entry["key_hash"] != key_hash or entry["key"] != key_bytes:
+                continue
+            if not self._is_fresh(entry):
+                break
+            # a racy timestamp write only makes the LRU order less exact
+            struct.pack_into("<d", self._map, offset + 20, time.time())
+            self.counts["hits"] += 1
+            return True, json.loads(entry["value"])
+        self.counts["misses"] += 1
+        return False, None
+
+    def set(self, key: str, value, tags=()):
+        """Caches value under key, evicting the least recently used entry of its set"""
+        key_bytes = key.encode("utf-8")
+        value_bytes = json.dumps(value).encode("utf-8")
+        if len(tags) > MAX_TAGS or SLOT_DATA + len(key_bytes) + len(value_bytes) > self.slot_size:
+            self.counts["oversize"] += 1
+            return
+        key_hash = _hash(key_bytes)
+        with self._write_lock():
+            offset = self._choose_slot(key_hash, key_bytes)
+            tag_entries = []
+            for tag in tags:
+                index = self._tag_index(tag)
+                tag_entries.append((index, self._tag_generation(index)))
+            self._write_slot(offset, key_hash, key_bytes, value_bytes, tag_entries)
+
+    def invalidate(self, *tags):
+        """Makes every entry cached with any of the tags stale, in every process"""
+        with self._write_lock():
+            for tag in tags:
+                index = self._tag_index(tag)
+                offset = HEADER_SIZE + index * GENERATION.size
+                GENERATION.pack_into(self._map, offset, self._tag_generation(index) + 1)
+
+    def clear(self):
+        """Makes every entry stale, in every process"""
+        with self._write_lock():
+            header = list(HEADER.unpack_from(self._map, 0))
+            header[4] += 1
+            HEADER.pack_into(self._map, 0, *header)
+
+    def stats(self) -> dict:
+        """Returns the counters of this process and the memory use of the table"""
+        entries = 0
+        used_bytes = 0
+        for slot in range(self.slot_count):
+            entry = self._read_slot(self._slots_offset + slot * self.slot_size)
+            if entry is not None and entry["key"] and self._is_fresh(entry):
+                entries += 1
+                used_bytes += SLOT_DATA + len(entry["key"]) + len(entry["value"])
+        return {
+            "backend": "shared",
+            "hits": self.counts["hits"],
+            "misses": self.counts["misses"],
+            "evictions": HEADER.unpack_from(self._map, 0)[5],
+            "oversize": self.counts["oversize"],
+            "entries": entries,
+            "max_entries": self.slot_count,
+            "size_bytes": self.size,
+            "used_bytes": used_bytes,
+        }
+
+    ##################################################
+    # Table layout
+    ##################################################
+
+    def _format(self):
+        """Resets the file to an empty table, the caller must hold the write lock"""
+        os.ftruncate(self._fd, 0)
+        os.ftruncate(self._fd, self.size)
+        header = HEADER.pack(MAGIC, self.slot_size, self.slot_count, self.tag_count, 0, 0)
+        os.pwrite(self._fd, header, 0)
+
+    def _write_lock(self):
+        """Returns a context manager that excludes every other writer"""
+        return _FileLock(self._lock, self._fd)
+
+    def _set_offsets(self, key_hash: int) -> list:
+        """Returns the offsets of the slots that key_hash may be stored in"""
+        first = (key_hash % (self.slot_count // WAYS)) * WAYS
+        return [self._slots_offset + (first + way) * self.slot_size for way in range(WAYS)]
+
+    def _tag_index(self, tag: str) -> int:
+        return _hash(tag.encode("utf-8")) % self.tag_count
+
+    def _tag_generation(self, index: int) -> int:
+        return GENERATION.unpack_from(self._map, HEADER_SIZE + index * GENERATION.size)[0]
+
+    def _is_fresh(self, entry: dict) -> bool:
+        """Returns True if an entry has not expired nor been invalidated"""
+        if entry["expires"] <= time.time():
+            return False
+        if entry["generation"] != HEADER.unpack_from(self._map, 0)[4]:
+            return False
+        return all(self._tag_generation(index) == generation for index, generation in entry["tags"])
+
+    def _choose_slot(self, key_hash: int, key_bytes: bytes) -> int:
+        """Returns the slot to write key to, the caller must hold the write lock"""
+        victim, oldest = None, float("inf")
+        for offset in self._set_offsets(key_hash):
+            entry = self._read_slot(offset)
+            if entry is None:
+                # a writer died half way through this slot
+                return offset
+            if not entry["key"] or (entry["key_hash"] == key_hash and entry["key"] == key_bytes):
+                return offset
+            if not self._is_fresh(entry):
+                return offset
+            if entry["last_used"] < oldest:
+                victim, oldest = offset, entry["last_used"]
+        header = list(HEADER.unpack_from(self._map, 0))
+        header[5] += 1
+        HEADER.pack_into(self._map, 0, *header)
+        return victim
+
+    def _read_slot(self, offset: int):
+        """Returns a consistent copy of a slot, or None if it kept changing"""
+        for _ in range(READ_RETRIES):
+            sequence = SEQUENCE.unpack_from(self._map, offset)[0]
+            if sequence % 2:
+                continue
+            _, key_hash, expires, last_used, key_len, value_len, generation, tag_count = SLOT.unpack_from(
+                self._map, offset
+            )
+            tags = [
+                SLOT_TAG.unpack_from(self._map, offset + SLOT.size + tag * SLOT_TAG.size)
+                for tag in range(min(tag_count, MAX_TAGS))
+            ]
+            start = offset + SLOT_DATA
+            data = self._map[start:start + min(key_len + value_len, self.slot_size - SLOT_DATA)]
+            if SEQUENCE.unpack_from(self._map, offset)[0] == sequence:
+                return {
+                    "key_hash": key_hash,
+                    "expires": expires,
+                    "last_used": last_used,
+                    "generation": generation,
+                    "tags": tags,
+                    "key": data[:key_len],
+                    "value": data[key_len:],
+                }
+        return None
+
+    def _write_slot(self, offset, key_hash, key_bytes, value_bytes, tag_entries):
+        """Writes an entry, the caller must hold the write lock"""
+        sequence = SEQUENCE.unpack_from(self._map, offset)[0] | 1
+        SEQUENCE.pack_into(self._map, offset, sequence)
+        now = time.time()
+        generation = HEADER.unpack_from(self._map, 0)[4]
+        SLOT.pack_into(
+            self._map,
+            offset,
+            sequence,
+            key_hash,
+            now + self.ttl,
+            now,
+            len(key_bytes),
+            len(value_bytes),
+            generation,
+            len(tag_entries),
+        )
+        for position, (index, tag_generation) in enumerate(tag_entries):
+            SLOT_TAG.pack_into(self._map, offset + SLOT.size + position * SLOT_TAG.size, index, tag_generation)
+        start = offset + SLOT_DATA
+        self._map[start:start + len(key_bytes) + len(value_bytes)] = key_bytes + value_bytes
+        SEQUENCE.pack_into(self._map, offset, (sequence + 1) % 2**32)
+
+
+class _FileLock:  # pylint: disable=too-few-public-methods
+    """Holds a thread lock and an exclusive flock on a file"""
+
+    def __init__(self, thread_lock, fd):
+        self._thread_lock = thread_lock
+        self._fd = fd
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
@@ -19,7 +19,7 @@ Module: error_handlers
 
 from flask import current_app as app  # Import Flask application
 from service import api
-from service.models import DataValidationError
+from service.models import DataValidationError, DuplicateRecommendationError
 from . import status
 
 
@@ -36,3 +36,15 @@ def request_validation_error(error):
         "error": "Bad Request",
         "message": message,
     }, status.HTTP_400_BAD_REQUEST
+
+
+@api.errorhandler(DuplicateRecommendationError)
+def duplicate_recommendation_error(error):
+    """Handles conflicts with an existing Recommendation"""
+    message = str(error)
+    app.logger.error(message)
+    return {
+        "status_code": status.HTTP_409_CONFLICT,
+        "error": "Conflict",
+        "message": message,
+    }, status.HTTP_409_CONFLICT
@@ -16,6 +16,31 @@ SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 # SQLALCHEMY_POOL_SIZE = 2
 
+# Keyset pagination of list requests
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Recommendations kept per product and type in the top list
+TOP_N_SIZE = int(os.getenv("TOP_N_SIZE", "20"))
+
+# Read-through cache of recommendation lookups
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() in ("true", "1", "yes")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "5"))
+# "memory" keeps a cache per process, "shared" one per pod in shared memory,
+# "redis" one for every replica
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_SHM_PATH = os.getenv("CACHE_SHM_PATH", "")
+CACHE_SHM_SIZE = int(os.getenv("CACHE_SHM_SIZE", str(16 * 1024 * 1024)))
+CACHE_SHM_SLOT_SIZE = int(os.getenv("CACHE_SHM_SLOT_SIZE", "8192"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+CACHE_REDIS_PREFIX = os.getenv("CACHE_REDIS_PREFIX", "recommendation:")
+CACHE_REDIS_TIMEOUT = float(os.getenv("CACHE_REDIS_TIMEOUT", "0.5"))
+
+# Bulk create: rows per INSERT / transaction and items per request
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "1000"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "50000"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
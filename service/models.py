@@ -4,9 +4,17 @@ Models for Recommendation
 All of the models are stored in this module
 """
 
+import json
 import logging
+import sqlite3
 from enum import Enum
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+from service.cache import cache
 
 logger = logging.getLogger("flask.app")
 
@@ -26,6 +34,10 @@ class TextColumnLimitExceededError(Exception):
     """Used when column character limit has been exceeded"""
 
 
+class DuplicateRecommendationError(Exception):
+    """Used when a Recommendation with the same products and type already exists"""
+
+
 class RecommendationType(Enum):
     """Enum representing types of recommendation"""
 
@@ -37,8 +49,23 @@ class RecommendationType(Enum):
 
 SKU_CHAR_LIMIT = 10
 
+# INSERT constructs that support ON CONFLICT DO NOTHING
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+@event.listens_for(Engine, "connect")
+def _sqlite_begin_immediate(dbapi_connection, _):
+    """Makes the sqlite3 driver begin its transactions with BEGIN IMMEDIATE
+
+    The driver begins a transaction before the first write. A deferred one
+    fails at once with "database is locked" when another transaction is
+    writing; an immediate one waits for it, like a row lock in Postgres.
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = "IMMEDIATE"
+
 
-class Recommendation(db.Model):
+class Recommendation(db.Model):  # pylint: disable=too-many-public-methods
     """
     Class that represents a Recommendation
     """
@@ -52,6 +79,27 @@ class Recommendation(db.Model):
     recommendation_type = db.Column(db.Enum(RecommendationType), nullable=False)
     likes = db.Column(db.Integer, nullable=False, default=0)
 
+    __table_args__ = (
+        # duplicates are rejected by the database instead of a separate SELECT
+        db.UniqueConstraint(
+            product_a_sku,
+            product_b_sku,
+            recommendation_type,
+            name="uq_recommendation_product_a_sku_product_b_sku_type",
+        ),
+        # covers find_by_product_a_sku and find_by_product_a_sku_and_type
+        db.Index(
+            "ix_recommendation_product_a_sku_type_likes",
+            product_a_sku,
+            recommendation_type,
+            likes.desc(),
+            id,
+            postgresql_include=["product_b_sku"],
+        ),
+        # covers find_by_type
+        db.Index("ix_recommendation_type_id", recommendation_type, id),
+    )
+
     name = f"{product_a_sku}-{product_b_sku}"
 
     def __repr__(self):
@@ -71,11 +119,21 @@ class Recommendation(db.Model):
                 raise DataValidationError("Likes cannot be negative: " + self.likes)
 
             db.session.add(self)
+            db.session.flush()
+            tags = self.cache_tags()
+            RecommendationTop.place(self)
             db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            logger.warning("Duplicate record: %s", self)
+            raise DuplicateRecommendationError(
+                "Duplicate recommendation detected."
+            ) from e
         except Exception as e:
             db.session.rollback()
             logger.error("Error creating record: %s", self)
             raise DataValidationError(e) from e
+        cache.invalidate(*tags)
 
     def update(self):
         """
@@ -91,22 +149,41 @@ class Recommendation(db.Model):
                 # don't allow negative likes
                 raise DataValidationError("Likes cannot be negative: " + self.likes)
 
+            tags = self.cache_tags()
+            groups = self.top_groups()
+            db.session.flush()
+            for group in groups:
+                RecommendationTop.refresh(*group)
             db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            logger.warning("Duplicate record: %s", self)
+            raise DuplicateRecommendationError(
+                "Duplicate recommendation detected."
+            ) from e
         except Exception as e:
             db.session.rollback()
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
+        cache.invalidate(*tags)
 
     def delete(self):
         """Removes a Recommendation from the data store"""
         logger.info("Deleting %s", self.name)
         try:
+            tags = self.cache_tags()
+            listed = RecommendationTop.remove(self)
             db.session.delete(self)
+            db.session.flush()
+            if listed:
+                # a Recommendation from outside of the list takes its place
+                RecommendationTop.refresh(self.product_a_sku, self.recommendation_type)
             db.session.commit()
         except Exception as e:
             db.session.rollback()
             logger.error("Error deleting record: %s", self)
             raise DataValidationError(e) from e
+        cache.invalidate(*tags)
 
     def exists(self) -> bool:
         """Returns True if Recommendation with given data exists in the database, false otherwise"""
@@ -122,6 +199,40 @@ class Recommendation(db.Model):
             is not None
         )
 
+    def cache_tags(self) -> set:
+        """Returns the tags of every cache entry that may hold this Recommendation
+
+        Both the current and the previously saved product a sku are included,
+        so that an update invalidates the lists it leaves as well as those it joins.
+        """
+        history = db.inspect(self).attrs.product_a_sku.history
+        skus = set(history.added or ()) | set(history.unchanged or ())
+        skus |= set(history.deleted or ())
+        return {f"id:{self.id}"} | {f"sku:{sku}" for sku in skus}
+
+    def top_groups(self) -> set:
+        """Returns the (product a sku, type) of every top list this Recommendation may change
+
+        Like cache_tags, the previously saved values are included as well.
+        """
+        state = db.inspect(self).attrs
+        skus = state.product_a_sku.history.sum() or [self.product_a_sku]
+        types = state.recommendation_type.history.sum() or [self.recommendation_type]
+        return {(sku, recommendation_type) for sku in skus for recommendation_type in types}
+
+    def key(self) -> tuple:
+        """Returns the values that identify a unique Recommendation"""
+        return (self.product_a_sku, self.product_b_sku, self.recommendation_type)
+
+    def row(self) -> dict:
+        """Returns the column values used to insert a Recommendation"""
+        return {
+            "product_a_sku": self.product_a_sku,
+            "product_b_sku": self.product_b_sku,
+            "recommendation_type": self.recommendation_type,
+            "likes": self.likes or 0,
+        }
+
     def serialize(self):
         """Serializes a Recommendation into a dictionary"""
         return {
@@ -185,16 +296,18 @@ class Recommendation(db.Model):
     def add_like(self):
         """Increments like counter by one"""
         logger.info("Adding like for %s", self.name)
-        self.likes += 1
-        self.update()
+        self._sync_likes(Recommendation.adjust_likes(self.id, 1))
 
     def remove_like(self):
         """Decrements like counter by one"""
         logger.info("Decrementing like for %s", self.name)
-        if self.likes <= 0:
-            raise DataValidationError("Likes cannot be negative")
-        self.likes -= 1
-        self.update()
+        self._sync_likes(Recommendation.adjust_likes(self.id, -1))
+
+    def _sync_likes(self, updated):
+        """Copies the likes counter from the database without marking it dirty"""
+        if updated is None:
+            raise DataValidationError(f"Recommendation with id {self.id} not found")
+        set_committed_value(self, "likes", updated.likes)
 
     ##################################################
     # CLASS METHODS
@@ -212,6 +325,268 @@ class Recommendation(db.Model):
         logger.info("Processing lookup for id %s ...", by_id)
         return db.session.get(cls, by_id)
 
+    @classmethod
+    def create_many(cls, recommendations, chunk_size: int = 1000) -> list:
+        """Inserts Recommendations with one multi-row INSERT per chunk
+
+        Every chunk is committed in its own transaction. Recommendations that
+        already exist, or repeat an earlier one in the batch, are skipped.
+
+        :param recommendations: a list of Recommendations that have not been saved
+        :param chunk_size: the number of rows sent in each INSERT
+
+        :return: the new id of every Recommendation in order, None for duplicates
+        :rtype: list
+        """
+        logger.info("Creating %d Recommendations in bulk", len(recommendations))
+        created_ids = {}
+        seen = set()
+        for start in range(0, len(recommendations), chunk_size):
+            rows = []
+            for recommendation in recommendations[start:start + chunk_size]:
+                key = recommendation.key()
+                if key not in seen:
+                    seen.add(key)
+                    rows.append(recommendation.row())
+            if rows:
+                created_ids.update(cls._insert_chunk(rows))
+
+        for recommendation in recommendations:
+            recommendation.id = created_ids.pop(recommendation.key(), None)
+        return [recommendation.id for recommendation in recommendations]
+
+    @classmethod
+    def _insert_chunk(cls, rows: list) -> dict:
+        """Inserts rows in one transaction and returns the new ids by key"""
+        table = cls.__table__
+        key_columns = [
+            table.c.product_a_sku,
+            table.c.product_b_sku,
+            table.c.recommendation_type,
+        ]
+        insert = UPSERT_INSERTS[db.session.get_bind().dialect.name]
+        statement = (
+            insert(table)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=key_columns)
+            .returning(table.c.id, *key_columns)
+        )
+        created_ids = {}
+        tags = set()
+        try:
+            for row in db.session.execute(statement):
+                created_ids[tuple(row[1:])] = row.id
+                tags.update((f"id:{row.id}", f"sku:{row.product_a_sku}"))
+            for product_a_sku, recommendation_type in {(key[0], key[2]) for key in created_ids}:
+                RecommendationTop.refresh(product_a_sku, recommendation_type)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error creating records in bulk")
+            raise DataValidationError(e) from e
+        cache.invalidate(*tags)
+        return created_ids
+
+    @classmethod
+    def delete_all(cls, product_a_sku=None, recommendation_type=None) -> int:
+        """Deletes the matching Recommendations with a single DELETE statement
+
+        Both filters are optional; with neither every Recommendation is deleted.
+
+        :param product_a_sku: only delete Recommendations for this product a sku
+        :param recommendation_type: only delete Recommendations of this type
+
+        :return: the number of Recommendations deleted
+        :rtype: int
+        """
+        logger.info(
+            "Deleting Recommendations for %s and %s ...",
+            product_a_sku,
+            recommendation_type,
+        )
+        filters = {}
+        if product_a_sku is not None:
+            filters["product_a_sku"] = product_a_sku
+        if recommendation_type is not None:
+            filters["recommendation_type"] = recommendation_type
+        try:
+            db.session.execute(db.delete(RecommendationTop).filter_by(**filters))
+            deleted = db.session.execute(db.delete(cls).filter_by(**filters)).rowcount
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error deleting records in bulk")
+            raise DataValidationError(e) from e
+        # the deleted ids are unknown, so drop every cached lookup
+        cache.clear()
+
+        return deleted
+
+    @classmethod
+    def adjust_likes(cls, by_id, delta: int):
+        """Atomically adds delta to the likes counter of a Recommendation
+
+        The change and the non-negative check run as a single
+        UPDATE ... RETURNING statement, so concurrent likes are never lost.
+
+        :param by_id: the id of the Recommendation
+        :param delta: the amount to add to likes (negative to remove likes)
+
+        :return: a detached Recommendation holding the updated row,
+            or None if no Recommendation has the given id
+        :raises DataValidationError: if the change would make likes negative
+        """
+        logger.info("Adjusting likes for id %s by %d ...", by_id, delta)
+        table = cls.__table__
+        statement = (
+            table.update()
+            .where(table.c.id == by_id, table.c.likes + delta >= 0)
+            .values(likes=table.c.likes + delta)
+            .returning(*table.c)
+        )
+        try:
+            row = db.session.execute(statement).first()
+            if row is None and delta < 0 and db.session.get(cls, by_id):
+                raise DataValidationError("Likes cannot be negative")
+            if row is not None:
+                RecommendationTop.adjust(row, delta)
+            db.session.commit()
+        except DataValidationError:
+            db.session.rollback()
+            raise
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error adjusting likes for id: %s", by_id)
+            raise DataValidationError(e) from e
+
+        if row is None:
+            return None
+        cache.invalidate(f"id:{row.id}", f"sku:{row.product_a_sku}")
+        return cls(**row._mapping)
+
+    @classmethod
+    def lookup(cls, by_id):
+        """Returns the serialized Recommendation with the given id, or None
+
+        The result, including a miss, is cached until the Recommendation changes.
+        """
+        try:
+            key = f"id:{int(by_id)}"
+        except (TypeError, ValueError):
+            key = None
+
+        def load():
+            recommendation = cls.find(by_id)
+            return recommendation.serialize() if recommendation else None
+
+        if key is None:
+            return load()
+        return cache.fetch(key, (key,), load)
+
+    @classmethod
+    def find_page(cls, product_a_sku=None, recommendation_type=None, limit=100, after=None):
+        """Returns a page of serialized Recommendations matching the filters
+
+        Pages filtered by product a sku are cached until one of the
+        Recommendations of that product changes. The first page of a product
+        and type is read from RecommendationTop when it is small enough.
+
+        :return: the serialized Recommendations on the page and the cursor of
+            the next page, which is None on the last page
+        :rtype: tuple
+        """
+
+        def load():
+            if product_a_sku and recommendation_type and after is None and limit <= RecommendationTop.size:
+                return RecommendationTop.page(product_a_sku, recommendation_type, limit)
+            query, by_likes = cls.find_by_filters(product_a_sku, recommendation_type)
+            recommendations, cursor = cls.paginate(query, limit, after, by_likes)
+            return [recommendation.serialize() for recommendation in recommendations], cursor
+
+        if product_a_sku is None:
+            return load()
+        type_name = recommendation_type.name if recommendation_type else None
+        key = "page:" + json.dumps([product_a_sku, type_name, limit, after])
+        return cache.fetch(key, (f"sku:{product_a_sku}",), load)
+
+    @classmethod
+    def find_by_filters(cls, product_a_sku=None, recommendation_type=None) -> tuple:
+        """Returns the query for the list filters and whether it is ordered by likes
+
+        :param product_a_sku: only match Recommendations for this product a sku
+        :param recommendation_type: only match Recommendations of this type
+        """
+        if product_a_sku and recommendation_type:
+            return cls.find_by_product_a_sku_and_type(product_a_sku, recommendation_type), True
+        if product_a_sku:
+            return cls.find_by_product_a_sku(product_a_sku), False
+        if recommendation_type:
+            return cls.find_by_type(recommendation_type), False
+        return cls.query, False
+
+    @classmethod
+    def paginate(cls, query, limit: int, after: str = None, by_likes: bool = False):
+        """Returns one page of a query using keyset pagination
+
+        Pages are ordered by id, or by likes (most liked first) and then id,
+        so that every page is a single index range scan whatever its position.
+
+        :param query: the query to paginate, any ordering is replaced
+        :param limit: the maximum number of Recommendations on the page
+        :param after: the cursor returned with the previous page
+        :param by_likes: order by likes and then id instead of by id
+
+        :return: the Recommendations on the page and the cursor of the next
+            page, which is None on the last page
+        :rtype: tuple
+        """
+        logger.info("Processing page of %d after %s ...", limit, after)
+        query = cls._seek(query, after, by_likes)
+        recommendations = query.limit(limit + 1).all()
+        if len(recommendations) <= limit:
+            return recommendations, None
+
+        recommendations = recommendations[:limit]
+        last = recommendations[-1]
+        cursor = f"{last.likes}.{last.id}" if by_likes else str(last.id)
+        return recommendations, cursor
+
+    @classmethod
+    def stream(cls, query, after: str = None, by_likes: bool = False, batch_size: int = 1000):
+        """Returns an iterable over every Recommendation of a query
+
+        Rows are fetched from a server-side cursor batch_size at a time, so they
+        are never all loaded at once. They come in the same order as paginate.
+
+        :param query: the query to stream, any ordering is replaced
+        :param after: the cursor of a page to start after
+        :param by_likes: order by likes and then id instead of by id
+        :param batch_size: the number of rows fetched from the database at once
+        """
+        logger.info("Processing stream after %s ...", after)
+        return cls._seek(query, after, by_likes).yield_per(batch_size)
+
+    @classmethod
+    def _seek(cls, query, after: str, by_likes: bool):
+        """Orders a query for keyset pagination and skips the rows up to after"""
+        query = query.order_by(None)
+        try:
+            if by_likes:
+                query = query.order_by(cls.likes.desc(), cls.id)
+                if after:
+                    likes, last_id = (int(value) for value in after.split("."))
+                    query = query.filter(
+                        cls.likes <= likes,
+                        db.or_(cls.likes < likes, cls.id > last_id),
+                    )
+            else:
+                query = query.order_by(cls.id)
+                if after:
+                    query = query.filter(cls.id > int(after))
+        except ValueError as error:
+            raise DataValidationError(f"Invalid cursor: {after}") from error
+        return query
+
     @classmethod
     def find_by_product_a_sku(cls, sku):
         """Returns all Recommendations with the given product a sku
@@ -255,10 +630,177 @@ class Recommendation(db.Model):
             recommendation_type.name,
         )
 
-        return (
-            cls.query.filter_by(
-                product_a_sku=product_a_sku, recommendation_type=recommendation_type
+        return cls.query.filter_by(
+            product_a_sku=product_a_sku, recommendation_type=recommendation_type
+        ).order_by(cls.likes.desc(), cls.id)
+
+
+class RecommendationTop(db.Model):
+    """
+    Class that represents the most liked Recommendations of a product and type
+
+    A derived table holding the first size + 1 Recommendations of every
+    (product a sku, type) in list order, the extra one telling whether there is
+    a next page. Every write of Recommendations keeps it current, so the top N
+    of a product are read in O(N) without sorting the recommendation table.
+    """
+
+    __tablename__ = "recommendation_top"
+
+    size = 20  # set from TOP_N_SIZE by init_app()
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    id = db.Column(
+        db.Integer,
+        db.ForeignKey(Recommendation.id, ondelete="CASCADE"),
+        primary_key=True,
+    )
+    product_a_sku = db.Column(db.String(SKU_CHAR_LIMIT), nullable=False)
+    product_b_sku = db.Column(db.String(SKU_CHAR_LIMIT), nullable=False)
+    recommendation_type = db.Column(db.Enum(RecommendationType), nullable=False)
+    likes = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index(
+            "ix_recommendation_top_product_a_sku_type_likes",
+            product_a_sku,
+            recommendation_type,
+            likes.desc(),
+            id,
+        ),
+    )
+
+    serialize = Recommendation.serialize
+
+    def __repr__(self):
+        return f"<RecommendationTop {self.product_a_sku}-{self.product_b_sku} id=[{self.id}]>"
+
+    ##################################################
+    # CLASS METHODS
+    ##################################################
+
+    @classmethod
+    def init_app(cls, app):
+        """Sets the size from the app configuration and fills an empty table"""
+        cls.size = app.config["TOP_N_SIZE"]
+        empty = db.session.execute(db.select(cls.id).limit(1)).first() is None
+        if empty and db.session.execute(db.select(Recommendation.id).limit(1)).first():
+            app.logger.info("Building the top %d index ...", cls.size)
+            cls.rebuild()
+            db.session.commit()
+
+    @classmethod
+    def rebuild(cls):
+        """Recomputes every row with one INSERT ... SELECT, in the current transaction"""
+        rank = (
+            db.func.row_number()
+            .over(
+                partition_by=(Recommendation.product_a_sku, Recommendation.recommendation_type),
+                order_by=(Recommendation.likes.desc(), Recommendation.id),
             )
-            .order_by(cls.likes.desc())
-            .all()
+            .label("rank")
         )
+        columns = cls._columns()
+        ranked = db.select(*(getattr(Recommendation, column) for column in columns), rank).subquery()
+        db.session.execute(db.delete(cls))
+        db.session.execute(
+            db.insert(cls).from_select(
+                columns,
+                db.select(*(ranked.c[column] for column in columns)).where(ranked.c.rank <= cls.size + 1),
+            )
+        )
+
+    @classmethod
+    def refresh(cls, product_a_sku, recommendation_type):
+        """Recomputes the rows of one product and type, in the current transaction"""
+        logger.info("Refreshing top of %s and %s ...", product_a_sku, recommendation_type.name)
+        columns = cls._columns()
+        rows = db.session.execute(
+            Recommendation.find_by_product_a_sku_and_type(product_a_sku, recommendation_type)
+            .with_entities(*(getattr(Recommendation, column) for column in columns))
+            .limit(cls.size + 1)
+            .statement
+        ).all()
+        statement = db.delete(cls).filter_by(product_a_sku=product_a_sku, recommendation_type=recommendation_type)
+        if rows:
+            statement = statement.where(cls.id.not_in([row.id for row in rows]))
+        db.session.execute(statement)
+        if rows:
+            insert = UPSERT_INSERTS[db.session.get_bind().dialect.name](cls).values([row._asdict() for row in rows])
+            db.session.execute(
+                insert.on_conflict_do_update(
+                    index_elements=[cls.id],
+                    set_={column: insert.excluded[column] for column in columns[1:]},
+                )
+            )
+
+    @classmethod
+    def place(cls, recommendation):
+        """Refreshes the list of a Recommendation that was created or liked if it may now be in it"""
+        count, lowest = cls._bounds(recommendation)
+        if count <= cls.size or recommendation.likes >= lowest:
+            cls.refresh(recommendation.product_a_sku, recommendation.recommendation_type)
+
+    @classmethod
+    def adjust(cls, recommendation, delta: int):
+        """Follows a change of the likes of a Recommendation, in the current transaction
+
+        A row in the list is updated in place: it can only pass other rows of
+        the list, unless it drops to the last place of a full list, where a
+        row outside of it may now come first.
+        """
+        statement = db.update(cls).where(cls.id == recommendation.id).values(likes=recommendation.likes)
+        listed = db.session.execute(statement).rowcount
+        if not listed:
+            if delta > 0:
+                cls.place(recommendation)
+            return
+        if delta < 0:
+            count, lowest = cls._bounds(recommendation)
+            if count > cls.size and recommendation.likes <= lowest:
+                cls.refresh(recommendation.product_a_sku, recommendation.recommendation_type)
+
+    @classmethod
+    def remove(cls, recommendation) -> bool:
+        """Removes a Recommendation that is being deleted, in the current transaction
+
+        :return: True if it was in the list, which then needs a refresh
+            once the Recommendation is gone
+        """
+        statement = db.delete(cls).where(cls.id == recommendation.id)
+        return db.session.execute(statement).rowcount > 0
+
+    @classmethod
+    def page(cls, product_a_sku, recommendation_type, limit: int) -> tuple:
+        """Returns the first page of a product and type, like Recommendation.find_page
+
+        :param limit: the number of Recommendations on the page, at most size
+        """
+        logger.info("Processing top %d of %s and %s ...", limit, product_a_sku, recommendation_type.name)
+        rows = db.session.execute(
+            db.select(cls)
+            .filter_by(product_a_sku=product_a_sku, recommendation_type=recommendation_type)
+            .order_by(cls.likes.desc(), cls.id)
+            .limit(limit + 1)
+        ).scalars()
+        results = [row.serialize() for row in rows]
+        if len(results) <= limit:
+            return results, None
+        last = results[limit - 1]
+        return results[:limit], f"{last['likes']}.{last['id']}"
+
+    @classmethod
+    def _bounds(cls, recommendation) -> tuple:
+        """Returns the number of rows and the lowest likes of the list of a Recommendation"""
+        return db.session.execute(
+            db.select(db.func.count(), db.func.min(cls.likes)).where(
+                cls.product_a_sku == recommendation.product_a_sku,
+                cls.recommendation_type == recommendation.recommendation_type,
+            )
+        ).one()
+
+    @staticmethod
+    def _columns() -> list:
+        return ["id", "product_a_sku", "product_b_sku", "recommendation_type", "likes"]
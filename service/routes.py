@@ -22,10 +22,11 @@ This service implements a REST API that allows you to Create, Read, Update
 and Delete Recommendations from the inventory of recommendations in the RecommendationShop
 """
 
-from flask import request, jsonify
+import json
+from flask import Response, request, jsonify, stream_with_context
 from flask import current_app as app  # Import Flask
-from flask_restx import Resource, fields, reqparse
-from service.models import Recommendation, RecommendationType
+from flask_restx import Resource, fields, inputs, marshal, reqparse
+from service.models import Recommendation, RecommendationType, DataValidationError
 from service.common import status  # HTTP Status Codes
 from . import api
 
@@ -90,6 +91,29 @@ recommendation_model = api.inherit(
     },
 )
 
+batch_result_model = api.model(
+    "BatchItemResult",
+    {
+        "index": fields.Integer(description="Position of the item in the request"),
+        "status": fields.String(
+            enum=["created", "duplicate", "invalid"],
+            description="What happened to the item",
+        ),
+        "id": fields.Integer(description="The id of the created Recommendation"),
+        "message": fields.String(description="Why the item was invalid"),
+    },
+)
+
+batch_model = api.model(
+    "BatchResult",
+    {
+        "created": fields.Integer(description="Number of Recommendations created"),
+        "duplicates": fields.Integer(description="Number of duplicates skipped"),
+        "invalid": fields.Integer(description="Number of items that failed validation"),
+        "results": fields.List(fields.Nested(batch_result_model)),
+    },
+)
+
 # query string arguments
 recommendation_args = reqparse.RequestParser()
 recommendation_args.add_argument(
@@ -107,6 +131,37 @@ recommendation_args.add_argument(
     help='Denotes the relationship between product a and product b, one of {"UP_SELL", "CROSS_SELL", "ACCESSORY", "BUNDLE"}',
 )
 
+delete_args = recommendation_args.copy()
+delete_args.add_argument(
+    "all",
+    type=inputs.boolean,
+    location="args",
+    required=False,
+    default=False,
+    help="Must be true to delete every Recommendation when no other filter is given",
+)
+
+list_args = recommendation_args.copy()
+list_args.add_argument(
+    "limit",
+    type=inputs.positive,
+    location="args",
+    required=False,
+    help="The maximum number of Recommendations on the page, capped by MAX_PAGE_SIZE",
+)
+list_args.add_argument(
+    "after",
+    type=str,
+    location="args",
+    required=False,
+    help="The cursor of the page to return, taken from the X-Next-Cursor header",
+)
+
+delete_model = api.model(
+    "DeleteResult",
+    {"deleted": fields.Integer(description="Number of Recommendations deleted")},
+)
+
 
 ######################################################################
 #  PATH: /recommendations/{id}
@@ -138,7 +193,7 @@ class RecommendationResource(Resource):
 
         app.logger.info("Request for recommendation with id: %s", recommendation_id)
 
-        recommendation = Recommendation.find(recommendation_id)
+        recommendation = Recommendation.lookup(recommendation_id)
         if not recommendation:
             error(
                 status.HTTP_404_NOT_FOUND,
@@ -146,7 +201,7 @@ class RecommendationResource(Resource):
             )
 
         app.logger.info("Returning recommendation: %s", recommendation_id)
-        return recommendation.serialize(), status.HTTP_200_OK
+        return recommendation, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING RECOMMENDATION
@@ -154,6 +209,7 @@ class RecommendationResource(Resource):
     @api.doc("update_recommendations")
     @api.response(404, "Recommendation with id was not found")
     @api.response(400, "The Recommendation data was not valid")
+    @api.response(409, "Duplicate recommendation detected.")
     @api.expect(create_model)
     @api.marshal_with(recommendation_model)
     def put(self, recommendation_id):
@@ -218,38 +274,70 @@ class RecommendationCollection(Resource):
     # LIST ALL RECOMMENDATIONS
     ######################################################################
     @api.doc("list_recommendations")
-    @api.expect(recommendation_args, validate=True)
-    @api.marshal_list_with(recommendation_model)
+    @api.expect(list_args, validate=True)
+    @api.response(200, "Success", [recommendation_model])
+    @api.doc(produces=["application/json", "application/x-ndjson"])
     def get(self):
         """
         List Recommendations
 
-        Returns list of Recommendations that satify condition in filter.
+        Returns a page of Recommendations that satify condition in filter.
+        The cursor of the next page is sent in the X-Next-Cursor and Link headers.
+        With Accept: application/x-ndjson every matching Recommendation is
+        streamed instead, one JSON object per line.
         """
         app.logger.info("Request for recommendation list")
 
-        recommendations = []
-        args = recommendation_args.parse_args()
-        # See if any query filters were passed in
-        a_sku = args["product_a_sku"]
-        recommendation_type = args["recommendation_type"]
-
-        if a_sku and recommendation_type:
-            type_value = getattr(RecommendationType, recommendation_type.upper())
-            recommendations = Recommendation.find_by_product_a_sku_and_type(
-                a_sku, type_value
-            )
-        elif a_sku:
-            recommendations = Recommendation.find_by_product_a_sku(a_sku)
-        elif recommendation_type:
-            type_value = getattr(RecommendationType, recommendation_type.upper())
-            recommendations = Recommendation.find_by_type(type_value)
-        else:
-            recommendations = Recommendation.all()
-
-        results = [recommendation.serialize() for recommendation in recommendations]
+        args = list_args.parse_args()
+        a_sku, type_value = parse_filters(args)
+
+        if wants_ndjson():
+            query, by_likes = Recommendation.find_by_filters(a_sku, type_value)
+            recommendations = Recommendation.stream(query, args["after"], by_likes)
+            return stream_ndjson(recommendations)
+
+        limit = min(
+            args["limit"] or app.config["DEFAULT_PAGE_SIZE"],
+            app.config["MAX_PAGE_SIZE"],
+        )
+        results, cursor = Recommendation.find_page(
+            a_sku, type_value, limit, args["after"]
+        )
         app.logger.info("Returning %d recommendations", len(results))
-        return results, status.HTTP_200_OK
+        return (
+            marshal(results, recommendation_model),
+            status.HTTP_200_OK,
+            next_page_headers(args, limit, cursor),
+        )
+
+    ######################################################################
+    # DELETE MANY RECOMMENDATIONS
+    ######################################################################
+    @api.doc("delete_recommendations_by_filter")
+    @api.expect(delete_args, validate=True)
+    @api.response(400, "No filter was given and all was not true")
+    @api.response(200, "Recommendations deleted", delete_model)
+    def delete(self):
+        """
+        Deletes Recommendations
+
+        This endpoint will delete every Recommendation that matches the filters
+        with a single statement. Deleting everything requires all=true
+        """
+        app.logger.info("Request to delete recommendations by filter")
+        args = delete_args.parse_args()
+        a_sku, type_value = parse_filters(args)
+
+        if not (a_sku or type_value or args["all"]):
+            error(
+                status.HTTP_400_BAD_REQUEST,
+                "Pass a filter, or all=true to delete every recommendation.",
+            )
+
+        deleted = Recommendation.delete_all(a_sku, type_value)
+
+        app.logger.info("Deleted %d recommendations.", deleted)
+        return {"deleted": deleted}, status.HTTP_200_OK
 
     ######################################################################
     # CREATE A NEW RECOMMENDATION
@@ -271,10 +359,7 @@ class RecommendationCollection(Resource):
 
         recommendation = Recommendation()
         recommendation.deserialize(api.payload)
-
-        if recommendation.exists():
-            error(status.HTTP_409_CONFLICT, "Duplicate recommendation detected.")
-
+        # duplicates are rejected by the unique constraint and mapped to 409
         recommendation.create()
         message = recommendation.serialize()
         location_url = api.url_for(
@@ -289,6 +374,65 @@ class RecommendationCollection(Resource):
         )
 
 
+######################################################################
+#  PATH: /recommendations/batch
+######################################################################
+@api.route("/recommendations/batch")
+class RecommendationBatch(Resource):
+    """Handles creating Recommendations in bulk"""
+
+    ######################################################################
+    # CREATE MANY RECOMMENDATIONS
+    ######################################################################
+    @api.doc("create_recommendations_batch")
+    @api.response(400, "The posted data was not a list of Recommendations")
+    @api.response(413, "Too many Recommendations in one batch")
+    @api.response(
+        415, "Content-Type must be application/json or application/x-ndjson"
+    )
+    @api.expect([create_model])
+    @api.response(200, "Batch processed", batch_model)
+    def post(self):
+        """
+        Creates many Recommendations
+
+        This endpoint accepts a JSON array, or one JSON object per line with
+        Content-Type application/x-ndjson, and reports the outcome of every item
+        """
+        app.logger.info("Request to create recommendations in bulk")
+        check_content_type("application/json", "application/x-ndjson")
+
+        results = []
+        recommendations = []
+        for position, data in enumerate(read_batch_items()):
+            if position >= app.config["BATCH_MAX_SIZE"]:
+                error(
+                    status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    f"A batch can hold at most {app.config['BATCH_MAX_SIZE']} items.",
+                )
+            try:
+                if isinstance(data, DataValidationError):
+                    raise data
+                recommendations.append(Recommendation().deserialize(data))
+                results.append({"index": position, "status": "created"})
+            except DataValidationError as err:
+                results.append(
+                    {"index": position, "status": "invalid", "message": str(err)}
+                )
+
+        ids = Recommendation.create_many(
+            recommendations, app.config["BATCH_CHUNK_SIZE"]
+        )
+        summary = summarize_batch(results, ids)
+        app.logger.info(
+            "Batch processed: %d created, %d duplicates, %d invalid",
+            summary["created"],
+            summary["duplicates"],
+            summary["invalid"],
+        )
+        return summary, status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /recommendations/{id}/like
 ######################################################################
@@ -313,15 +457,13 @@ class LikeResource(Resource):
             recommendation_id,
         )
 
-        recommendation = Recommendation.find(recommendation_id)
+        recommendation = Recommendation.adjust_likes(recommendation_id, 1)
         if not recommendation:
             error(
                 status.HTTP_404_NOT_FOUND,
                 f"Recommendation with id '{recommendation_id}' was not found.",
             )
 
-        recommendation.add_like()
-
         app.logger.info(
             "Recommendation with ID: %d - likes field incremented.", recommendation.id
         )
@@ -343,15 +485,13 @@ class LikeResource(Resource):
             recommendation_id,
         )
 
-        recommendation = Recommendation.find(recommendation_id)
+        recommendation = Recommendation.adjust_likes(recommendation_id, -1)
         if not recommendation:
             error(
                 status.HTTP_404_NOT_FOUND,
                 f"Recommendation with id '{recommendation_id}' was not found.",
             )
 
-        recommendation.remove_like()
-
         app.logger.info(
             "Recommendation with ID: %d - likes field decremented.", recommendation.id
         )
@@ -366,23 +506,138 @@ class LikeResource(Resource):
 ######################################################################
 # Checks the ContentType of a request
 ######################################################################
-def check_content_type(content_type):
-    """Checks that the media type is correct"""
+def check_content_type(*content_types):
+    """Checks that the media type is one of the accepted ones"""
+    expected = " or ".join(content_types)
     if "Content-Type" not in request.headers:
         app.logger.error("No Content-Type specified.")
         error(
             status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-            f"Content-Type must be {content_type}",
+            f"Content-Type must be {expected}",
         )
 
-    if request.headers["Content-Type"] == content_type:
+    if request.headers["Content-Type"] in content_types:
         return
 
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
     error(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-        f"Content-Type must be {content_type}",
+        f"Content-Type must be {expected}",
+    )
+
+
+######################################################################
+# Reads the filters of a list or delete request
+######################################################################
+def parse_filters(args: dict) -> tuple:
+    """Returns the product a sku and RecommendationType filters, or None for each one missing"""
+    a_sku = args["product_a_sku"] or None
+    recommendation_type = args["recommendation_type"]
+    if recommendation_type:
+        return a_sku, parse_recommendation_type(recommendation_type)
+    return a_sku, None
+
+
+######################################################################
+# Checks whether the client asked for newline delimited JSON
+######################################################################
+def wants_ndjson() -> bool:
+    """Returns True if the Accept header prefers application/x-ndjson"""
+    best = request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson"]
     )
+    return best == "application/x-ndjson"
+
+
+######################################################################
+# Streams Recommendations as newline delimited JSON
+######################################################################
+def stream_ndjson(recommendations) -> Response:
+    """Returns a response that writes one JSON line per Recommendation as it is read"""
+
+    def generate():
+        count = 0
+        for recommendation in recommendations:
+            count += 1
+            yield json.dumps(recommendation.serialize()) + "\n"
+        app.logger.info("Streamed %d recommendations", count)
+
+    return Response(
+        stream_with_context(generate()),
+        status=status.HTTP_200_OK,
+        mimetype="application/x-ndjson",
+    )
+
+
+######################################################################
+# Builds the headers that point at the next page of a list
+######################################################################
+def next_page_headers(args: dict, limit: int, cursor: str) -> dict:
+    """Returns the X-Next-Cursor and Link headers for the next page, if any"""
+    if cursor is None:
+        return {}
+    params = {
+        name: value
+        for name, value in args.items()
+        if value is not None and name in ("product_a_sku", "recommendation_type")
+    }
+    next_url = api.url_for(
+        RecommendationCollection, limit=limit, after=cursor, _external=True, **params
+    )
+    return {"X-Next-Cursor": cursor, "Link": f'<{next_url}>; rel="next"'}
+
+
+######################################################################
+# Converts a recommendation type query argument
+######################################################################
+def parse_recommendation_type(value: str) -> RecommendationType:
+    """Returns the RecommendationType named by value, case insensitive"""
+    if value.upper() not in RecommendationType.__members__:
+        error(status.HTTP_400_BAD_REQUEST, f"Invalid recommendation_type: {value}")
+    return RecommendationType[value.upper()]
+
+
+######################################################################
+# Reads the items of a bulk request
+######################################################################
+def read_batch_items():
+    """Yields the items of a JSON array or of a newline delimited JSON body"""
+    if request.headers["Content-Type"] == "application/json":
+        items = api.payload
+        if not isinstance(items, list):
+            error(status.HTTP_400_BAD_REQUEST, "Request body must be a JSON array.")
+        yield from items
+        return
+
+    for line in request.stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as err:
+            # hand the error on so that the line is reported as an invalid item
+            yield DataValidationError(f"Invalid JSON: {err}")
+
+
+######################################################################
+# Summarizes the outcome of a bulk request
+######################################################################
+def summarize_batch(results: list, ids: list) -> dict:
+    """Fills in the ids of the valid items and counts the outcomes"""
+    ids = iter(ids)
+    for result in results:
+        if result["status"] == "created":
+            result["id"] = next(ids)
+            if result["id"] is None:
+                result["status"] = "duplicate"
+                del result["id"]
+
+    return {
+        "created": sum(result["status"] == "created" for result in results),
+        "duplicates": sum(result["status"] == "duplicate" for result in results),
+        "invalid": sum(result["status"] == "invalid" for result in results),
+        "results": results,
+    }
 
 
 ######################################################################
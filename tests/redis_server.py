@@ -0,0 +1,174 @@
+"""
+A stand-in Redis server for testing
+
+Speaks enough of the Redis protocol for the cache backend, keeping its data in
+a dict. Keys expire against the clock() function so tests can move time.
+"""
+
+import fnmatch
+import socketserver
+import threading
+import time
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    """A Redis server on a free local port, started with start()"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None):
+        super().__init__(("127.0.0.1", 0), RedisHandler)
+        self.password = password
+        self.data = {}  # db -> {key: value}, a value is bytes or a set
+        self.expires = {}  # (db, key) -> time
+        self.commands = []
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Returns the URL of the server for the cache backend"""
+        host, port = self.server_address
+        return f"redis://{host}:{port}/0"
+
+    def start(self):
+        """Serves connections in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving and closes the listening socket"""
+        self.shutdown()
+        self.server_close()
+
+    @staticmethod
+    def clock() -> float:
+        """Returns the time that keys expire against"""
+        return time.monotonic()
+
+    def keys(self, db: int = 0) -> dict:
+        """Returns the keys of a database that have not expired"""
+        with self.lock:
+            return {key: value for key, value in list(self.data.get(db, {}).items()) if self._alive(db, key)}
+
+    def _alive(self, db: int, key: bytes) -> bool:
+        expires = self.expires.get((db, key))
+        if expires is not None and expires <= self.clock():
+            self.data.get(db, {}).pop(key, None)
+            del self.expires[(db, key)]
+        return key in self.data.get(db, {})
+
+
+class RedisHandler(socketserver.StreamRequestHandler):
+    """Answers the commands of one connection"""
+
+    def setup(self):
+        super().setup()
+        self.db = 0
+        self.authenticated = self.server.password is None
+
+    def handle(self):
+        while True:
+            command = self._read_command()
+            if command is None:
+                return
+            self.server.commands.append(command)
+            with self.server.lock:
+                reply = self._run(command)
+            self.wfile.write(reply)
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        arguments = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            arguments.append(self.rfile.read(length + 2)[:-2])
+        return arguments
+
+    def _run(self, command) -> bytes:
+        name = command[0].decode().lower()
+        if name == "auth":
+            self.authenticated = command[1].decode() == self.server.password
+            return b"+OK\r\n" if self.authenticated else b"-WRONGPASS invalid password\r\n"
+        if not self.authenticated:
+            return b"-NOAUTH Authentication required.\r\n"
+        if name == "select":
+            self.db = int(command[1])
+            return b"+OK\r\n"
+        run = getattr(self, f"_{name}", None)
+        if run is None:
+            return b"-ERR unknown command '%s'\r\n" % command[0]
+        data = self.server.data.setdefault(self.db, {})
+        for key in list(data):
+            self.server._alive(self.db, key)
+        return run(data, *command[1:])
+
+    def _get(self, data, key):
+        value = data.get(key)
+        if isinstance(value, set):
+            return b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
+        return _bulk(value)
+
+    def _set(self, data, key, value, *options):
+        data[key] = value
+        self.server.expires.pop((self.db, key), None)
+        if options and options[0].upper() == b"PX":
+            self._expire(key, int(options[1]))
+        return b"+OK\r\n"
+
+    def _pexpire(self, data, key, milliseconds):
+        if key not in data:
+            return b":0\r\n"
+        self._expire(key, int(milliseconds))
+        return b":1\r\n"
+
+    def _del(self, data, *keys):
+        removed = [key for key in keys if data.pop(key, None) is not None]
+        for key in keys:
+            self.server.expires.pop((self.db, key), None)
+        return b":%d\r\n" % len(removed)
+
+    def _scan(self, data, _cursor, *options):
+        pattern = options[options.index(b"MATCH") + 1].decode()
+        matches = [key for key in data if fnmatch.fnmatchcase(key.decode(), pattern)]
+        return b"*2\r\n" + _bulk(b"0") + _array(matches)
+
+    def _sadd(self, data, key, *members):
+        if not isinstance(data.setdefault(key, set()), set):
+            return b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
+        before = len(data[key])
+        data[key].update(members)
+        return b":%d\r\n" % (len(data[key]) - before)
+
+    def _srem(self, data, key, *members):
+        if not isinstance(data.get(key, set()), set):
+            return b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
+        before = len(data.get(key, ()))
+        remaining = data.get(key, set()) - set(members)
+        if remaining:
+            data[key] = remaining
+        else:
+            data.pop(key, None)
+        return b":%d\r\n" % (before - len(remaining))
+
+    def _smembers(self, data, key):
+        if not isinstance(data.get(key, set()), set):
+            return b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
+        return _array(sorted(data.get(key, ())))
+
+    def _expire(self, key, milliseconds):
+        self.server.expires[(self.db, key)] = self.server.clock() + milliseconds / 1000
+
+
+def _bulk(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def _array(values) -> bytes:
+    return b"*%d\r\n" % len(values) + b"".join(_bulk(value) for value in values)
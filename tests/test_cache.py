@@ -0,0 +1,407 @@
+"""
+Test cases for the Recommendation cache
+"""
+
+import io
+import itertools
+import multiprocessing
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from service.cache import Cache
+from service.cache.base import CacheBackend
+from service.cache.memory import MemoryCache
+from service.cache.redis import RedisCache, RedisError, _read_reply
+from service.cache.shared import SharedMemoryCache, SEQUENCE, default_path
+from tests.redis_server import RedisStandIn
+
+
+######################################################################
+#  M E M O R Y   C A C H E   T E S T   C A S E S
+######################################################################
+class TestMemoryCache(TestCase):
+    """In-process cache backend Tests"""
+
+    def setUp(self):
+        self.cache = MemoryCache(max_entries=3, ttl=10)
+
+    def test_get_and_set(self):
+        """It should return cached values, including None"""
+        self.assertEqual(self.cache.get("a"), (False, None))
+        self.cache.set("a", {"id": 1})
+        self.cache.set("b", None)
+        self.assertEqual(self.cache.get("a"), (True, {"id": 1}))
+        self.assertEqual(self.cache.get("b"), (True, None))
+        self.cache.set("a", {"id": 2}, ("id:2",))
+        self.assertEqual(self.cache.get("a"), (True, {"id": 2}))
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["entries"], 2)
+
+    def test_evicts_least_recently_used(self):
+        """It should evict the least recently used entry when full"""
+        for key in ("a", "b", "c"):
+            self.cache.set(key, key)
+        self.cache.get("a")
+        self.cache.set("d", "d")
+        self.assertEqual(self.cache.get("b"), (False, None))
+        for key in ("a", "c", "d"):
+            self.assertEqual(self.cache.get(key), (True, key))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_expires_entries(self):
+        """It should not return entries older than the TTL"""
+        with patch("service.cache.memory.time.monotonic", return_value=100.0):
+            self.cache.set("a", 1, ("tag",))
+        with patch("service.cache.memory.time.monotonic", return_value=109.0):
+            self.assertEqual(self.cache.get("a"), (True, 1))
+        with patch("service.cache.memory.time.monotonic", return_value=110.0):
+            self.assertEqual(self.cache.get("a"), (False, None))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_invalidate_by_tag(self):
+        """It should drop every entry with an invalidated tag"""
+        self.cache.set("a", 1, ("sku:A", "id:1"))
+        self.cache.set("b", 2, ("sku:A",))
+        self.cache.set("c", 3, ("sku:C",))
+        self.cache.invalidate("sku:A", "sku:unknown")
+        self.assertEqual(self.cache.get("a"), (False, None))
+        self.assertEqual(self.cache.get("b"), (False, None))
+        self.assertEqual(self.cache.get("c"), (True, 3))
+        self.cache.invalidate("id:1")
+        self.cache.clear()
+        self.assertEqual(self.cache.get("c"), (False, None))
+
+
+######################################################################
+#  S H A R E D   M E M O R Y   C A C H E   T E S T   C A S E S
+######################################################################
+def _fill_shared_cache(path):
+    """Runs in a child process to write to the shared cache"""
+    cache = SharedMemoryCache(path, size=256 * 1024, slot_size=512, tag_count=64)
+    cache.set("id:1", {"id": 1, "likes": 3}, ("id:1", "sku:A"))
+    cache.invalidate("sku:B")
+
+
+class TestSharedMemoryCache(TestCase):
+    """Shared memory cache backend Tests"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.directory.name, "cache")
+        self.cache = self._open()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _open(self, **kwargs):
+        options = {"size": 256 * 1024, "slot_size": 512, "tag_count": 64, "ttl": 10}
+        options.update(kwargs)
+        return SharedMemoryCache(self.path, **options)
+
+    def test_get_and_set(self):
+        """It should return cached values, including None"""
+        self.assertEqual(self.cache.get("a"), (False, None))
+        self.cache.set("a", {"id": 1})
+        self.cache.set("b", None)
+        self.cache.set("c", [[{"id": 1}], "1"])
+        self.assertEqual(self.cache.get("a"), (True, {"id": 1}))
+        self.assertEqual(self.cache.get("b"), (True, None))
+        self.assertEqual(self.cache.get("c"), (True, [[{"id": 1}], "1"]))
+        self.cache.set("a", {"id": 2})
+        self.assertEqual(self.cache.get("a"), (True, {"id": 2}))
+        stats = self.cache.stats()
+        self.assertEqual(stats["backend"], "shared")
+        self.assertEqual(stats["hits"], 4)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["entries"], 3)
+        self.assertEqual(stats["size_bytes"], os.path.getsize(self.path))
+        self.assertGreater(stats["used_bytes"], 0)
+
+    def test_shared_between_processes(self):
+        """It should share entries and invalidations with other processes"""
+        self.cache.set("page:B", [], ("sku:B",))
+        process = multiprocessing.get_context("fork").Process(
+            target=_fill_shared_cache, args=(self.path,)
+        )
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(self.cache.get("id:1"), (True, {"id": 1, "likes": 3}))
+        self.assertEqual(self.cache.get("page:B"), (False, None))
+
+        other = self._open()
+        other.invalidate("id:1")
+        self.assertEqual(self.cache.get("id:1"), (False, None))
+        other.set("id:2", {"id": 2})
+        other.clear()
+        self.assertEqual(self.cache.get("id:2"), (False, None))
+
+    def test_evicts_least_recently_used(self):
+        """It should evict the least recently used entry of a full set"""
+        cache = self._open(size=64 * 1024 + 4 * 512, tag_count=8)
+        self.assertEqual(cache.slot_count, 128)
+        cache = self._open(size=1024 + 4 * 512, tag_count=8)
+        self.assertEqual(cache.slot_count, 4)
+        with patch("service.cache.shared.time.time", side_effect=itertools.count(100, 0.001)):
+            for key in ("a", "b", "c", "d"):
+                cache.set(key, key)
+            cache.get("a")
+            cache.set("e", "e")
+            self.assertEqual(cache.get("b"), (False, None))
+            for key in ("a", "c", "d", "e"):
+                self.assertEqual(cache.get(key), (True, key))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_expires_entries(self):
+        """It should not return entries older than the TTL and reuse their slots"""
+        with patch("service.cache.shared.time.time", return_value=100.0):
+            self.cache.set("a", 1)
+        with patch("service.cache.shared.time.time", return_value=109.0):
+            self.assertEqual(self.cache.get("a"), (True, 1))
+        with patch("service.cache.shared.time.time", return_value=110.0):
+            self.assertEqual(self.cache.get("a"), (False, None))
+        cache = self._open(size=1024 + 4 * 512, tag_count=8)
+        with patch("service.cache.shared.time.time", return_value=100.0):
+            for key in ("a", "b", "c", "d"):
+                cache.set(key, key)
+        cache.set("e", "e")
+        self.assertEqual(cache.stats()["evictions"], 0)
+
+    def test_oversize_values(self):
+        """It should not cache values larger than a slot or with too many tags"""
+        self.cache.set("big", "x" * 1024)
+        self.cache.set("tags", 1, ("1", "2", "3", "4", "5"))
+        self.assertEqual(self.cache.get("big"), (False, None))
+        self.assertEqual(self.cache.get("tags"), (False, None))
+        self.assertEqual(self.cache.stats()["oversize"], 2)
+
+    def test_slot_being_written(self):
+        """It should treat a slot that is being written as missing"""
+        self.cache.set("a", 1)
+        offset = next(
+            offset
+            for offset in range(self.cache._slots_offset, self.cache.size, self.cache.slot_size)
+            if self.cache._read_slot(offset)["key"] == b"a"
+        )
+        SEQUENCE.pack_into(self.cache._map, offset, 7)
+        self.assertEqual(self.cache.get("a"), (False, None))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+        # a writer that died half way does not block the slot forever
+        self.cache.set("a", 2)
+        self.assertEqual(self.cache.get("a"), (True, 2))
+
+    def test_reformats_on_new_geometry(self):
+        """It should start from an empty table when the geometry changes"""
+        self.cache.set("a", 1)
+        self.assertEqual(self._open().get("a"), (True, 1))
+        self.assertEqual(self._open(slot_size=1024).get("a"), (False, None))
+
+    def test_too_small(self):
+        """It should not create a table without room for one set of slots"""
+        self.assertRaises(ValueError, self._open, size=1024)
+        self.assertRaises(ValueError, self._open, slot_size=64)
+
+    def test_default_path(self):
+        """It should default to a file in shared memory"""
+        self.assertTrue(default_path().endswith("recommendation-cache"))
+
+
+######################################################################
+#  R E D I S   C A C H E   T E S T   C A S E S
+######################################################################
+class TestRedisCache(TestCase):
+    """Redis cache backend Tests"""
+
+    def setUp(self):
+        self.server = RedisStandIn().start()
+        self.cache = RedisCache(self.server.url, ttl=10)
+
+    def tearDown(self):
+        self.cache.close()
+        self.server.stop()
+
+    def test_get_and_set(self):
+        """It should return cached values, including None"""
+        self.assertEqual(self.cache.get("a"), (False, None))
+        self.cache.set("a", {"id": 1})
+        self.cache.set("b", None)
+        self.cache.set("c", [[{"id": 1}], "1"])
+        self.assertEqual(self.cache.get("a"), (True, {"id": 1}))
+        self.assertEqual(self.cache.get("b"), (True, None))
+        self.assertEqual(self.cache.get("c"), (True, [[{"id": 1}], "1"]))
+        self.assertIn(b"recommendation:key:a", self.server.keys())
+        stats = self.cache.stats()
+        self.assertEqual(stats["backend"], "redis")
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["errors"], 0)
+
+    def test_shared_between_replicas(self):
+        """It should share entries and invalidations between replicas"""
+        other = RedisCache(self.server.url, ttl=10)
+        self.cache.set("id:1", {"id": 1}, ("id:1", "sku:A"))
+        self.cache.set("page:A", [], ("sku:A",))
+        self.cache.set("page:B", [], ("sku:B",))
+        self.assertEqual(other.get("id:1"), (True, {"id": 1}))
+        other.invalidate("sku:A")
+        other.invalidate()
+        self.assertEqual(self.cache.get("id:1"), (False, None))
+        self.assertEqual(self.cache.get("page:A"), (False, None))
+        self.assertEqual(self.cache.get("page:B"), (True, []))
+        other.clear()
+        self.assertEqual(self.cache.get("page:B"), (False, None))
+        self.assertEqual(self.server.keys(), {})
+        other.close()
+
+    def test_expires_entries(self):
+        """It should let the server expire entries after the TTL"""
+        with patch.object(RedisStandIn, "clock", return_value=100.0):
+            self.cache.set("a", 1, ("tag",))
+        with patch.object(RedisStandIn, "clock", return_value=109.0):
+            self.assertEqual(self.cache.get("a"), (True, 1))
+        with patch.object(RedisStandIn, "clock", return_value=110.0):
+            self.assertEqual(self.cache.get("a"), (False, None))
+            self.assertEqual(self.server.keys(), {})
+
+    def test_clears_only_its_prefix(self):
+        """It should only clear keys with its own prefix"""
+        other = RedisCache(self.server.url, ttl=10, prefix="other:")
+        other.set("a", 1)
+        self.cache.set("a", 2)
+        self.cache.clear()
+        self.assertEqual(other.get("a"), (True, 1))
+        other.close()
+
+    def test_authenticates_and_selects_database(self):
+        """It should send the password and database of the URL"""
+        server = RedisStandIn(password="p@ss").start()
+        host, port = server.server_address
+        cache = RedisCache(f"redis://:p%40ss@{host}:{port}/2", ttl=10)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), (True, 1))
+        self.assertEqual(server.commands[:2], [[b"AUTH", b"p@ss"], [b"SELECT", b"2"]])
+        self.assertIn(b"recommendation:key:a", server.keys(2))
+        self.assertEqual(cache.stats()["server"], f"{host}:{port}/2")
+        cache.close()
+        cache = RedisCache(f"redis://:wrong@{host}:{port}/2", ttl=10)
+        self.assertEqual(cache.get("a"), (False, None))
+        self.assertEqual(cache.stats()["errors"], 1)
+        server.stop()
+
+    def test_fails_open(self):
+        """It should count errors and miss when the server is unavailable"""
+        self.cache.set("a", 1, ("tag",))
+        self.server.stop()
+        self.cache.close()
+        self.assertEqual(self.cache.get("a"), (False, None))
+        self.cache.set("a", 1, ("tag",))
+        self.cache.invalidate("tag")
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()["errors"], 4)
+
+    def test_error_replies(self):
+        """It should treat error replies as failures"""
+        self.cache._execute(("SET", "recommendation:tag:t", "1"))
+        self.cache.invalidate("t")
+        self.cache.set("x", 1, ("t",))
+        self.assertEqual(self.cache.stats()["errors"], 2)
+        self.assertRaises(RedisError, self.cache._execute, ("FLUSHALL",))
+
+    def test_read_reply(self):
+        """It should read every RESP reply type"""
+        self.assertEqual(_read_reply(io.BytesIO(b"+OK\r\n")), "OK")
+        self.assertEqual(_read_reply(io.BytesIO(b":3\r\n")), 3)
+        self.assertIsNone(_read_reply(io.BytesIO(b"$-1\r\n")))
+        self.assertIsNone(_read_reply(io.BytesIO(b"*-1\r\n")))
+        self.assertIsInstance(_read_reply(io.BytesIO(b"-ERR no\r\n")), RedisError)
+        self.assertRaises(RedisError, _read_reply, io.BytesIO(b"%1\r\n"))
+        self.assertRaises(ConnectionError, _read_reply, io.BytesIO(b""))
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestCache(TestCase):
+    """Read-through cache Tests"""
+
+    def _init_cache(self, enabled, backend="memory", redis_url=""):
+        app = Flask(__name__)
+        app.config.update(
+            CACHE_ENABLED=enabled,
+            CACHE_BACKEND=backend,
+            CACHE_MAX_ENTRIES=10,
+            CACHE_TTL=10,
+            CACHE_SHM_PATH=os.path.join(tempfile.gettempdir(), "test-recommendation-cache"),
+            CACHE_SHM_SIZE=1024 * 1024,
+            CACHE_SHM_SLOT_SIZE=1024,
+            CACHE_REDIS_URL=redis_url,
+            CACHE_REDIS_PREFIX="test:",
+            CACHE_REDIS_TIMEOUT=0.5,
+        )
+        cache = Cache()
+        cache.init_app(app)
+        return cache
+
+    def test_fetch(self):
+        """It should call the loader only on a miss"""
+        cache = self._init_cache(True)
+        self.assertTrue(cache.enabled)
+        calls = []
+        for _ in range(2):
+            self.assertEqual(cache.fetch("k", ("t",), lambda: calls.append(1) or "v"), "v")
+        self.assertEqual(len(calls), 1)
+        cache.invalidate("t")
+        cache.fetch("k", ("t",), lambda: calls.append(1) or "v")
+        cache.clear()
+        cache.fetch("k", ("t",), lambda: calls.append(1) or "v")
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(cache.stats()["backend"], "memory")
+
+    def test_shared_backend(self):
+        """It should use the shared memory backend when configured"""
+        cache = self._init_cache(True, "shared")
+        self.assertIsInstance(cache.backend, SharedMemoryCache)
+        cache.clear()
+        self.assertEqual(cache.fetch("k", ("t",), lambda: ["v"]), ["v"])
+        self.assertEqual(cache.fetch("k", ("t",), lambda: None), ["v"])
+
+    def test_redis_backend(self):
+        """It should use the Redis backend when configured"""
+        server = RedisStandIn().start()
+        cache = self._init_cache(True, "redis", server.url)
+        self.assertIsInstance(cache.backend, RedisCache)
+        self.assertEqual(cache.fetch("k", ("t",), lambda: ["v"]), ["v"])
+        self.assertEqual(cache.fetch("k", ("t",), lambda: None), ["v"])
+        self.assertIn(b"test:key:k", server.keys())
+        cache.backend.close()
+        server.stop()
+
+    def test_unknown_backend(self):
+        """It should not start with an unknown backend"""
+        self.assertRaises(ValueError, self._init_cache, True, "memcached")
+
+    def test_backend_interface(self):
+        """It should require backends to implement the interface"""
+        backend = CacheBackend()
+        self.assertRaises(NotImplementedError, CacheBackend.from_config, {})
+        self.assertRaises(NotImplementedError, backend.get, "k")
+        self.assertRaises(NotImplementedError, backend.set, "k", "v")
+        self.assertRaises(NotImplementedError, backend.invalidate, "t")
+        self.assertRaises(NotImplementedError, backend.clear)
+        self.assertRaises(NotImplementedError, backend.stats)
+
+    def test_disabled(self):
+        """It should always call the loader when disabled"""
+        cache = self._init_cache(False)
+        self.assertFalse(cache.enabled)
+        calls = []
+        for _ in range(2):
+            cache.fetch("k", ("t",), lambda: calls.append(1) or "v")
+        cache.invalidate("t")
+        cache.clear()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.stats(), {"backend": None})
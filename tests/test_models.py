@@ -6,13 +6,17 @@ import os
 import logging
 from unittest import TestCase
 from unittest.mock import patch
+import factory
 from wsgi import app
 from service.models import (
     Recommendation,
+    RecommendationTop,
     RecommendationType,
     DataValidationError,
+    DuplicateRecommendationError,
     db,
 )
+from service.cache import cache
 from tests.factories import RecommendationFactory
 
 DATABASE_URI = os.getenv(
@@ -44,8 +48,10 @@ class TestCaseBase(TestCase):
 
     def setUp(self):
         """This runs before each test"""
+        db.session.query(RecommendationTop).delete()
         db.session.query(Recommendation).delete()  # clean up the last tests
         db.session.commit()
+        cache.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -160,6 +166,55 @@ class TestRecommendationModel(TestCaseBase):
         self.assertEqual(recommendations[0].id, original_id)
         self.assertEqual(recommendations[0].product_a_sku, "ABC")
 
+    def test_create_duplicate_recommendation(self):
+        """It should not Create a Recommendation with the same products and type twice"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        duplicate = Recommendation(
+            product_a_sku=recommendation.product_a_sku,
+            product_b_sku=recommendation.product_b_sku,
+            recommendation_type=recommendation.recommendation_type,
+        )
+        self.assertRaises(DuplicateRecommendationError, duplicate.create)
+        self.assertEqual(len(Recommendation.all()), 1)
+
+    def test_update_duplicate_recommendation(self):
+        """It should not Update a Recommendation into a duplicate of another one"""
+        first, second = RecommendationFactory.create_batch(2)
+        first.create()
+        second.create()
+        second.product_a_sku = first.product_a_sku
+        second.product_b_sku = first.product_b_sku
+        second.recommendation_type = first.recommendation_type
+        self.assertRaises(DuplicateRecommendationError, second.update)
+
+    def test_create_many_recommendations(self):
+        """It should Create many Recommendations in chunks and skip duplicates"""
+        existing = RecommendationFactory()
+        existing.create()
+        recommendations = RecommendationFactory.create_batch(5)
+        duplicate = Recommendation(
+            product_a_sku=existing.product_a_sku,
+            product_b_sku=existing.product_b_sku,
+            recommendation_type=existing.recommendation_type,
+        )
+        repeated = Recommendation(
+            product_a_sku=recommendations[0].product_a_sku,
+            product_b_sku=recommendations[0].product_b_sku,
+            recommendation_type=recommendations[0].recommendation_type,
+        )
+        ids = Recommendation.create_many(
+            recommendations + [duplicate, repeated], chunk_size=2
+        )
+        self.assertEqual(len(ids), 7)
+        self.assertEqual(ids[5:], [None, None])
+        self.assertEqual(len(Recommendation.all()), 6)
+        for recommendation, new_id in zip(recommendations, ids):
+            self.assertEqual(recommendation.id, new_id)
+            found = Recommendation.find(new_id)
+            self.assertEqual(found.product_b_sku, recommendation.product_b_sku)
+            self.assertEqual(found.likes, recommendation.likes)
+
     def test_update_no_id(self):
         """It should not Update a Recommendation with no id"""
         recommendation = RecommendationFactory()
@@ -338,6 +393,33 @@ class TestRecommendationModel(TestCaseBase):
 
         self.assertRaises(DataValidationError, recommendation.remove_like)
 
+    def test_adjust_likes(self):
+        """It should atomically adjust likes by id without loading the Recommendation"""
+        recommendation = RecommendationFactory(likes=1)
+        recommendation.create()
+
+        updated = Recommendation.adjust_likes(recommendation.id, 1)
+        self.assertEqual(updated.id, recommendation.id)
+        self.assertEqual(updated.likes, 2)
+        self.assertEqual(updated.product_a_sku, recommendation.product_a_sku)
+
+        updated = Recommendation.adjust_likes(recommendation.id, -2)
+        self.assertEqual(updated.likes, 0)
+        self.assertRaises(
+            DataValidationError, Recommendation.adjust_likes, recommendation.id, -1
+        )
+        self.assertEqual(Recommendation.find(recommendation.id).likes, 0)
+
+    def test_adjust_likes_not_found(self):
+        """It should return None when adjusting likes of a missing Recommendation"""
+        self.assertIsNone(Recommendation.adjust_likes(0, 1))
+        self.assertIsNone(Recommendation.adjust_likes(0, -1))
+
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        Recommendation.query.filter_by(id=recommendation.id).delete()
+        self.assertRaises(DataValidationError, recommendation.add_like)
+
 
 ######################################################################
 #  T E S T   E X C E P T I O N   H A N D L E R S
@@ -366,6 +448,27 @@ class TestExceptionHandlers(TestCaseBase):
         recommendation = RecommendationFactory()
         self.assertRaises(DataValidationError, recommendation.delete)
 
+    @patch("service.models.db.session.commit")
+    def test_create_many_exception(self, exception_mock):
+        """It should catch a bulk create exception"""
+        exception_mock.side_effect = Exception()
+        recommendations = RecommendationFactory.create_batch(2)
+        self.assertRaises(
+            DataValidationError, Recommendation.create_many, recommendations
+        )
+
+    @patch("service.models.db.session.commit")
+    def test_delete_all_exception(self, exception_mock):
+        """It should catch a bulk delete exception"""
+        exception_mock.side_effect = Exception()
+        self.assertRaises(DataValidationError, Recommendation.delete_all)
+
+    @patch("service.models.db.session.commit")
+    def test_adjust_likes_exception(self, exception_mock):
+        """It should catch an adjust likes exception"""
+        exception_mock.side_effect = Exception()
+        self.assertRaises(DataValidationError, Recommendation.adjust_likes, 1, 1)
+
 
 ######################################################################
 #  Q U E R Y   T E S T   C A S E S
@@ -445,6 +548,26 @@ class TestModelQueries(TestCaseBase):
         for recommendation in found:
             self.assertEqual(recommendation.recommendation_type, recommendation_type)
 
+    def test_delete_all(self):
+        """It should Delete the Recommendations matching the filters"""
+        for recommendation in RecommendationFactory.create_batch(10):
+            recommendation.create()
+        recommendations = Recommendation.all()
+        sku = recommendations[0].product_a_sku
+        recommendation_type = recommendations[0].recommendation_type
+        matching = [
+            recommendation
+            for recommendation in recommendations
+            if recommendation.product_a_sku == sku
+            and recommendation.recommendation_type == recommendation_type
+        ]
+        self.assertEqual(
+            Recommendation.delete_all(sku, recommendation_type), len(matching)
+        )
+        self.assertEqual(len(Recommendation.all()), 10 - len(matching))
+        self.assertEqual(Recommendation.delete_all(), 10 - len(matching))
+        self.assertEqual(Recommendation.all(), [])
+
     def test_exists(self):
         """It should return True if recommendation exists in the database, false otherwise"""
         recommendation = Recommendation(
@@ -494,7 +617,7 @@ class TestModelQueries(TestCaseBase):
         # Call the method under test
         results = Recommendation.find_by_product_a_sku_and_type(
             "SKU1", RecommendationType.UP_SELL
-        )
+        ).all()
 
         # Assert the results are as expected
         self.assertEqual(len(results), 2)
@@ -507,3 +630,264 @@ class TestModelQueries(TestCaseBase):
             results[0].product_b_sku, "SKU3"
         )  # Assuming the first result is the most liked
         self.assertEqual(results[1].product_b_sku, "SKU2")
+
+    def test_paginate_by_id(self):
+        """It should return pages of Recommendations ordered by id"""
+        for recommendation in RecommendationFactory.create_batch(5):
+            recommendation.create()
+        ids = sorted(recommendation.id for recommendation in Recommendation.all())
+
+        page, cursor = Recommendation.paginate(Recommendation.query, 2)
+        self.assertEqual([recommendation.id for recommendation in page], ids[:2])
+        self.assertEqual(cursor, str(ids[1]))
+        page, cursor = Recommendation.paginate(Recommendation.query, 2, cursor)
+        self.assertEqual([recommendation.id for recommendation in page], ids[2:4])
+        page, cursor = Recommendation.paginate(Recommendation.query, 2, cursor)
+        self.assertEqual([recommendation.id for recommendation in page], ids[4:])
+        self.assertIsNone(cursor)
+
+    def test_paginate_by_likes(self):
+        """It should return pages of Recommendations ordered by likes and then id"""
+        for product_b_sku, likes in (("B1", 3), ("B2", 5), ("B3", 3), ("B4", 1), ("B5", 3)):
+            Recommendation(
+                product_a_sku="A1",
+                product_b_sku=product_b_sku,
+                recommendation_type=RecommendationType.UP_SELL,
+                likes=likes,
+            ).create()
+        query = Recommendation.find_by_product_a_sku_and_type(
+            "A1", RecommendationType.UP_SELL
+        )
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = Recommendation.paginate(query, 2, cursor, by_likes=True)
+            seen.extend(recommendation.product_b_sku for recommendation in page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, ["B2", "B1", "B3", "B5", "B4"])
+
+    def test_paginate_bad_cursor(self):
+        """It should not paginate with a malformed cursor"""
+        query = Recommendation.query
+        self.assertRaises(DataValidationError, Recommendation.paginate, query, 2, "x")
+        self.assertRaises(
+            DataValidationError, Recommendation.paginate, query, 2, "1", True
+        )
+
+
+######################################################################
+#  C A C H E D   L O O K U P   T E S T   C A S E S
+######################################################################
+class TestCachedLookups(TestCaseBase):
+    """Recommendation read-through cache Tests"""
+
+    def test_lookup(self):
+        """It should Lookup a serialized Recommendation through the cache"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        data = Recommendation.lookup(recommendation.id)
+        self.assertEqual(data, recommendation.serialize())
+        hits = cache.stats()["hits"]
+        self.assertEqual(Recommendation.lookup(str(recommendation.id)), data)
+        self.assertEqual(cache.stats()["hits"], hits + 1)
+        self.assertIsNone(Recommendation.lookup("not-an-id"))
+
+    def test_lookup_caches_misses(self):
+        """It should cache a missing Recommendation until one is created with its id"""
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        next_id = recommendation.id + 1
+        self.assertIsNone(Recommendation.lookup(next_id))
+        with patch("service.models.Recommendation.find") as find_mock:
+            self.assertIsNone(Recommendation.lookup(next_id))
+            find_mock.assert_not_called()
+
+        recommendation = RecommendationFactory()
+        recommendation.create()
+        self.assertEqual(recommendation.id, next_id)
+        self.assertEqual(Recommendation.lookup(next_id)["id"], next_id)
+
+    def test_lookup_invalidated_by_writes(self):
+        """It should not return a cached Recommendation after it changes"""
+        recommendation = RecommendationFactory(likes=0)
+        recommendation.create()
+        Recommendation.lookup(recommendation.id)
+
+        Recommendation.adjust_likes(recommendation.id, 1)
+        self.assertEqual(Recommendation.lookup(recommendation.id)["likes"], 1)
+
+        recommendation = Recommendation.find(recommendation.id)
+        recommendation.product_b_sku = "CHANGED"
+        recommendation.update()
+        self.assertEqual(Recommendation.lookup(recommendation.id)["product_b_sku"], "CHANGED")
+
+        recommendation.delete()
+        self.assertIsNone(Recommendation.lookup(recommendation.id))
+
+    def test_find_page_invalidated_by_writes(self):
+        """It should not return a cached page after a Recommendation of its product changes"""
+        recommendation = Recommendation(
+            product_a_sku="A1",
+            product_b_sku="B1",
+            recommendation_type=RecommendationType.UP_SELL,
+        )
+        recommendation.create()
+        page, cursor = Recommendation.find_page("A1", RecommendationType.UP_SELL, 10)
+        self.assertEqual([item["product_b_sku"] for item in page], ["B1"])
+        self.assertIsNone(cursor)
+
+        Recommendation.create_many(
+            [
+                Recommendation(
+                    product_a_sku="A1",
+                    product_b_sku="B2",
+                    recommendation_type=RecommendationType.UP_SELL,
+                    likes=5,
+                )
+            ]
+        )
+        page, _ = Recommendation.find_page("A1", RecommendationType.UP_SELL, 10)
+        self.assertEqual([item["product_b_sku"] for item in page], ["B2", "B1"])
+
+        # moving a Recommendation to another product invalidates both products
+        Recommendation.find_page("A2", None, 10)
+        recommendation = Recommendation.find(recommendation.id)
+        recommendation.product_a_sku = "A2"
+        recommendation.update()
+        page, _ = Recommendation.find_page("A1", None, 10)
+        self.assertEqual([item["product_b_sku"] for item in page], ["B2"])
+        page, _ = Recommendation.find_page("A2", None, 10)
+        self.assertEqual([item["product_b_sku"] for item in page], ["B1"])
+
+        Recommendation.delete_all("A2")
+        self.assertEqual(Recommendation.find_page("A2", None, 10), ([], None))
+        self.assertEqual(len(Recommendation.find_page(limit=10)[0]), 1)
+
+
+######################################################################
+#  T O P   L I S T   T E S T   C A S E S
+######################################################################
+class TestRecommendationTop(TestCaseBase):
+    """Top list of Recommendations Tests"""
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch.object(RecommendationTop, "size", 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create(self, product_a_sku, likes, recommendation_type=RecommendationType.UP_SELL):
+        recommendation = RecommendationFactory(
+            product_a_sku=product_a_sku, recommendation_type=recommendation_type, likes=likes
+        )
+        recommendation.create()
+        return recommendation
+
+    def assert_top(self, product_a_sku, recommendation_type=RecommendationType.UP_SELL):
+        """Checks the top list of a product against the recommendation table"""
+        query = Recommendation.find_by_product_a_sku_and_type(product_a_sku, recommendation_type)
+        expected = [recommendation.serialize() for recommendation in query.limit(4)]
+        listed = db.session.execute(
+            db.select(RecommendationTop)
+            .filter_by(product_a_sku=product_a_sku, recommendation_type=recommendation_type)
+            .order_by(RecommendationTop.likes.desc(), RecommendationTop.id)
+        ).scalars()
+        self.assertEqual([row.serialize() for row in listed], expected)
+        return [item["id"] for item in expected]
+
+    def test_create(self):
+        """It should keep the most liked Recommendations of a product and type"""
+        recommendations = [self._create("A1", likes) for likes in (5, 1, 7, 3, 2)]
+        self._create("A1", 0, RecommendationType.BUNDLE)
+        ids = self.assert_top("A1")
+        self.assertEqual(ids, [recommendations[i].id for i in (2, 0, 3, 4)])
+        self.assertEqual(len(self.assert_top("A1", RecommendationType.BUNDLE)), 1)
+        self.assertEqual(db.session.query(RecommendationTop).count(), 5)
+        self.assertIn("<RecommendationTop A1-", repr(db.session.get(RecommendationTop, recommendations[0].id)))
+
+    def test_likes(self):
+        """It should follow likes into and out of the list"""
+        recommendations = [self._create("A1", likes) for likes in (4, 3, 2, 1, 0)]
+        self.assertNotIn(recommendations[4].id, self.assert_top("A1"))
+        for _ in range(3):
+            Recommendation.adjust_likes(recommendations[4].id, 1)
+            self.assert_top("A1")
+        self.assertIn(recommendations[4].id, self.assert_top("A1"))
+        for _ in range(4):
+            Recommendation.adjust_likes(recommendations[0].id, -1)
+            self.assert_top("A1")
+        self.assertNotIn(recommendations[0].id, self.assert_top("A1"))
+        Recommendation.adjust_likes(recommendations[1].id, 1)
+        self.assertEqual(self.assert_top("A1")[0], recommendations[1].id)
+
+    def test_delete(self):
+        """It should fill the place of a deleted Recommendation"""
+        recommendations = [self._create("A1", likes) for likes in (4, 3, 2, 1, 0)]
+        recommendations[4].delete()
+        self.assertEqual(len(self.assert_top("A1")), 4)
+        recommendations[0].delete()
+        self.assertEqual(self.assert_top("A1"), [recommendation.id for recommendation in recommendations[1:4]])
+
+    def test_update(self):
+        """It should move an updated Recommendation between lists"""
+        recommendations = [self._create("A1", likes) for likes in (4, 3, 2, 1, 0)]
+        self._create("A2", 1)
+        recommendation = Recommendation.find(recommendations[0].id)
+        recommendation.product_a_sku = "A2"
+        recommendation.likes = 0
+        recommendation.update()
+        self.assertNotIn(recommendation.id, self.assert_top("A1"))
+        self.assertEqual(self.assert_top("A2")[-1], recommendation.id)
+        recommendation.recommendation_type = RecommendationType.BUNDLE
+        recommendation.update()
+        self.assertEqual(len(self.assert_top("A2")), 1)
+        self.assertEqual(self.assert_top("A2", RecommendationType.BUNDLE), [recommendation.id])
+
+    def test_bulk(self):
+        """It should follow bulk creates and deletes"""
+        recommendations = RecommendationFactory.create_batch(
+            20, product_a_sku=factory.Iterator(["A1", "A2"]), recommendation_type=RecommendationType.UP_SELL
+        )
+        with patch.object(RecommendationTop, "refresh", wraps=RecommendationTop.refresh) as refresh_mock:
+            Recommendation.create_many(recommendations, chunk_size=7)
+        # once per product and type of every chunk
+        self.assertEqual(refresh_mock.call_count, 6)
+        self.assertEqual(len(self.assert_top("A1")), 4)
+        self.assertEqual(len(self.assert_top("A2")), 4)
+        Recommendation.delete_all("A1")
+        self.assertEqual(self.assert_top("A1"), [])
+        self.assertEqual(len(self.assert_top("A2")), 4)
+
+    def test_find_page(self):
+        """It should read the first page of a product and type from the list"""
+        recommendations = [self._create("A1", likes) for likes in (5, 1, 7, 3, 2)]
+        with patch.object(Recommendation, "paginate", side_effect=AssertionError):
+            page, cursor = Recommendation.find_page("A1", RecommendationType.UP_SELL, 3)
+            self.assertEqual(Recommendation.find_page("A2", RecommendationType.UP_SELL, 3), ([], None))
+        self.assertEqual([item["likes"] for item in page], [7, 5, 3])
+        self.assertEqual(cursor, f"3.{recommendations[3].id}")
+        page, cursor = Recommendation.find_page("A1", RecommendationType.UP_SELL, 3, cursor)
+        self.assertEqual([item["likes"] for item in page], [2, 1])
+        self.assertIsNone(cursor)
+        recommendations[0].delete()
+        recommendations[1].delete()
+        cache.clear()
+        page, cursor = Recommendation.find_page("A1", RecommendationType.UP_SELL, 3)
+        self.assertEqual([item["likes"] for item in page], [7, 3, 2])
+        self.assertIsNone(cursor)
+
+    def test_init_app(self):
+        """It should build an empty list from the recommendation table"""
+        for likes in (5, 1, 7, 3, 2):
+            self._create("A1", likes)
+        self._create("A2", 0)
+        db.session.query(RecommendationTop).delete()
+        db.session.commit()
+        RecommendationTop.init_app(app)
+        self.assertEqual(RecommendationTop.size, app.config["TOP_N_SIZE"])
+        RecommendationTop.size = 3
+        self.assertEqual(len(self.assert_top("A2")), 1)
+        db.session.query(RecommendationTop).delete()
+        RecommendationTop.rebuild()
+        self.assertEqual(len(self.assert_top("A1")), 4)